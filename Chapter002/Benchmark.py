@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+
+import argparse
+import glob
+import json
+import numpy # Hint to PyInstaller
+import cv2
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows lacks the resource module, so RSS is not measured there.
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 lacks tracemalloc, so allocations are not traced there.
+    tracemalloc = None
+
+import HistogramClassifier as HC
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+# Operations are measured in child processes, so that each size starts
+# with a fresh heap. Within a child, the peak RSS is reset before each
+# operation where the platform allows it. The build child measures
+# addReference and serialize, the load child measures deserialize, and
+# the classify child loads the model (unmeasured) and measures classify.
+CHILD_OPERATIONS = {
+    'build': ('addReference', 'serialize'),
+    'load': ('deserialize',),
+    'classify': ('classify',)
+}
+
+
+def _resetPeakRss():
+    # Reset the peak RSS to the current RSS, which Linux supports since
+    # 4.0, and return whether it was reset.
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def _peakRssBytes():
+    # Return the peak RSS, or None if it cannot be measured.
+    try:
+        # Unlike ru_maxrss, VmHWM reflects a reset of the peak.
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes, while Linux reports kilobytes.
+        return peakRss
+    return peakRss * 1024
+
+def _currentRssBytes():
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * mmap.PAGESIZE
+    except (IOError, OSError):
+        # Fall back to the peak, which is at least the current RSS.
+        return _peakRssBytes()
+
+def _resize(image, maxSize):
+    h, w = image.shape[:2]
+    scale = float(maxSize) / max(h, w)
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, (max(1, int(w * scale)),
+                              max(1, int(h * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+def loadBundledImages(imageDir, maxSize):
+    images = []
+    for path in sorted(glob.glob(os.path.join(imageDir, '*.jpg'))):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append(_resize(image, maxSize))
+    if not images:
+        raise ValueError('Found no images in %s' % imageDir)
+    return images
+
+def createReferenceImages(bundledImages, count, numLabels, seed):
+    # The first references are the bundled images. The rest are
+    # synthetic variations of them, with a random crop and a random
+    # gain and offset per channel, so that their histograms are
+    # realistic but distinct. Each reference's label depends on its
+    # source image, so that the labels are of similar sizes.
+    random = numpy.random.RandomState(seed)
+    for i in range(count):
+        source = i % len(bundledImages)
+        image = bundledImages[source]
+        if i >= len(bundledImages):
+            h, w = image.shape[:2]
+            cropH = random.randint(h // 2, h + 1)
+            cropW = random.randint(w // 2, w + 1)
+            y = random.randint(0, h - cropH + 1)
+            x = random.randint(0, w - cropW + 1)
+            gains = random.uniform(0.8, 1.2, 3)
+            offsets = random.uniform(-20.0, 20.0, 3)
+            image = numpy.clip(
+                    image[y:y+cropH, x:x+cropW] * gains + offsets,
+                    0, 255).astype(numpy.uint8)
+        yield image, 'label%d' % (source % numLabels)
+
+def _configure(classifier, args):
+    classifier.useBinIndex = args.useBinIndex
+    classifier.usePruning = args.usePruning
+    classifier.useTwoStage = args.useTwoStage
+
+class _Measurement(object):
+
+    # Measures the wall time and RSS of an operation, and optionally
+    # the peak and retained size of its traced Python allocations.
+    # Allocations are traced in a separate run of the operation because
+    # tracing slows it down considerably.
+
+    def __init__(self, name, traceAllocations):
+        self.name = name
+        self.traceAllocations = traceAllocations
+        self.result = {}
+
+    def __enter__(self):
+        self._peakRssReset = _resetPeakRss()
+        self._peakRssBefore = _peakRssBytes()
+        self._rssBefore = _currentRssBytes()
+        if self.traceAllocations:
+            # Python 3.9 added reset_peak. Without it, the peak of the
+            # operation may be hidden by an earlier peak.
+            self._tracedPeakReset = hasattr(tracemalloc, 'reset_peak')
+            if self._tracedPeakReset:
+                tracemalloc.reset_peak()
+            self._tracedBefore, self._tracedPeakBefore = \
+                    tracemalloc.get_traced_memory()
+        self._startTime = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.result['wallSeconds'] = time.time() - self._startTime
+        if self._rssBefore is not None:
+            # Otherwise, the platform does not report RSS.
+            self.result['rssBeforeBytes'] = self._rssBefore
+            self.result['rssAfterBytes'] = _currentRssBytes()
+            peakRss = _peakRssBytes()
+            if not self._peakRssReset and peakRss <= self._peakRssBefore:
+                # The peak of the operation is hidden by an earlier peak
+                # in the same process.
+                peakRss = None
+            self.result['peakRssBytes'] = peakRss
+            self.result['peakRssIncreaseBytes'] = None if peakRss is None \
+                    else max(0, peakRss - self._rssBefore)
+        if self.traceAllocations:
+            # These are sizes of live, traced blocks, not the total
+            # volume allocated.
+            current, peak = tracemalloc.get_traced_memory()
+            if not self._tracedPeakReset and \
+                    peak <= self._tracedPeakBefore:
+                # The peak of the operation is hidden by an earlier peak.
+                self.result['tracedPeakBytes'] = None
+            else:
+                self.result['tracedPeakBytes'] = peak - self._tracedBefore
+            self.result['tracedRetainedBytes'] = \
+                    current - self._tracedBefore
+
+def runChild(args):
+    if args.traceAllocations:
+        tracemalloc.start()
+    bundledImages = loadBundledImages(args.imageDir, args.imageSize)
+    results = {}
+
+    if args.child == 'build':
+        images = list(createReferenceImages(
+                bundledImages, args.size, args.numLabels, args.seed))
+        classifier = HC.HistogramClassifier(args.binsPerChannel)
+        _configure(classifier, args)
+        with _Measurement('addReference', args.traceAllocations) as m:
+            for image, label in images:
+                classifier.addReference(image, label)
+        images = None
+        m.result['count'] = args.size
+        # The bytes held by the reference histograms.
+        m.result['referenceBytes'] = \
+                sum(classifier.memoryUsageByLabel().values())
+        results[m.name] = m.result
+        with _Measurement('serialize', args.traceAllocations) as m:
+            classifier.serialize(args.modelPath)
+        m.result['modelFileBytes'] = os.path.getsize(args.modelPath)
+        results[m.name] = m.result
+
+    elif args.child == 'load':
+        classifier = HC.HistogramClassifier(args.binsPerChannel)
+        _configure(classifier, args)
+        with _Measurement('deserialize', args.traceAllocations) as m:
+            classifier.deserialize(args.modelPath)
+        results[m.name] = m.result
+
+    elif args.child == 'classify':
+        classifier = HC.HistogramClassifier(args.binsPerChannel)
+        _configure(classifier, args)
+        classifier.deserialize(args.modelPath)
+        queryImages = bundledImages[:args.numQueries]
+        with _Measurement('classify', args.traceAllocations) as m:
+            for image in queryImages:
+                classifier.classify(image)
+        m.result['count'] = len(queryImages)
+        m.result['meanWallSeconds'] = \
+                m.result['wallSeconds'] / len(queryImages)
+        results[m.name] = m.result
+
+    json.dump(results, sys.stdout)
+
+def _runChildProcess(args, child, size, modelPath, traceAllocations):
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', child,
+               '--child-size', str(size),
+               '--child-model', modelPath,
+               '--images', args.imageDir,
+               '--image-size', str(args.imageSize),
+               '--labels', str(args.numLabels),
+               '--queries', str(args.numQueries),
+               '--bins', str(args.binsPerChannel),
+               '--seed', str(args.seed)]
+    if args.useBinIndex:
+        command.append('--bin-index')
+    if args.usePruning:
+        command.append('--pruning')
+    if args.useTwoStage:
+        command.append('--two-stage')
+    if traceAllocations:
+        command.append('--trace-allocations')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8'))
+
+def runBenchmark(args):
+    workDir = tempfile.mkdtemp(prefix='histogram-benchmark-')
+    try:
+        sizes = []
+        for size in args.sizes:
+            modelPath = os.path.join(workDir, 'model%d.%s' % \
+                                     (size, args.format))
+            operations = {}
+            for child in ('build', 'load', 'classify'):
+                results = _runChildProcess(args, child, size, modelPath,
+                                           False)
+                if args.measureAllocations:
+                    # Rebuilding writes an identical model.
+                    tracedResults = _runChildProcess(
+                            args, child, size, modelPath, True)
+                    for name, result in results.items():
+                        tracedResult = tracedResults[name]
+                        result['tracedPeakBytes'] = \
+                                tracedResult['tracedPeakBytes']
+                        result['tracedRetainedBytes'] = \
+                                tracedResult['tracedRetainedBytes']
+                operations.update(results)
+                if args.verbose:
+                    for name in CHILD_OPERATIONS[child]:
+                        sys.stderr.write(
+                                '%6d references: %-12s %9.3f s\n' % \
+                                (size, name,
+                                 results[name]['wallSeconds']))
+            sizes.append({
+                'references': size,
+                'modelFileBytes':
+                        operations['serialize']['modelFileBytes'],
+                'operations': operations
+            })
+            os.remove(modelPath)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return {
+        'version': 1,
+        'timestamp': time.time(),
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'opencv': cv2.__version__,
+        'numpy': numpy.__version__,
+        'settings': {
+            'format': args.format,
+            'binsPerChannel': args.binsPerChannel,
+            'imageSize': args.imageSize,
+            'labels': args.numLabels,
+            'queries': args.numQueries,
+            'seed': args.seed,
+            'useBinIndex': args.useBinIndex,
+            'usePruning': args.usePruning,
+            'useTwoStage': args.useTwoStage
+        },
+        'sizes': sizes
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Measure the wall time, peak RSS, peak and '
+                        'retained traced allocations and model file '
+                        'size of building, serializing, loading and '
+                        'classifying with a HistogramClassifier, for '
+                        'several numbers of '
+                        'references. The references are the bundled '
+                        'images plus synthetic variations of them. The '
+                        'results are written as JSON.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='numbers of references (default: %s)' % \
+                             ' '.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--output', '-o',
+                        help='write the JSON here instead of to stdout')
+    parser.add_argument('--images', dest='imageDir', default='images')
+    parser.add_argument('--image-size', dest='imageSize', type=int,
+                        default=320,
+                        help='maximum width or height of each image')
+    parser.add_argument('--labels', dest='numLabels', type=int, default=4)
+    parser.add_argument('--queries', dest='numQueries', type=int,
+                        default=10,
+                        help='maximum number of bundled images to '
+                             'classify')
+    parser.add_argument('--bins', dest='binsPerChannel', type=int,
+                        default=256)
+    parser.add_argument('--format', choices=('hist', 'mat'),
+                        default='hist')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bin-index', dest='useBinIndex',
+                        action='store_true')
+    parser.add_argument('--pruning', dest='usePruning',
+                        action='store_true')
+    parser.add_argument('--two-stage', dest='useTwoStage',
+                        action='store_true')
+    parser.add_argument('--no-allocations', dest='measureAllocations',
+                        action='store_false',
+                        help='skip the runs that trace allocations')
+    parser.add_argument('--quiet', dest='verbose', action='store_false')
+    # Internal arguments for the child processes.
+    parser.add_argument('--child', choices=sorted(CHILD_OPERATIONS),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child-size', dest='size', type=int,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child-model', dest='modelPath',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--trace-allocations', dest='traceAllocations',
+                        action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measureAllocations and tracemalloc is None:
+        sys.stderr.write('Skipping the traced allocations, which need '
+                         'Python 3.4 or later\n')
+        args.measureAllocations = False
+    if args.useBinIndex and (args.usePruning or args.useTwoStage):
+        parser.error('--bin-index cannot be combined with --pruning or '
+                     '--two-stage')
+
+    if args.child:
+        runChild(args)
+        return
+
+    report = runBenchmark(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
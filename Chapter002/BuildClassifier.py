@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import sys
+import time
+
+import FileUtils
+import HistogramClassifier as HC
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff',
+                    '.webp')
+
+# The classifier of a worker process, used to create histograms.
+_workerClassifier = None
+
+def _initWorker(binsPerChannel):
+    global _workerClassifier
+    _workerClassifier = HC.HistogramClassifier(binsPerChannel)
+
+def _hashAndCreateHist(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8),
+                         cv2.IMREAD_COLOR)
+    if image is None:
+        return sha1, None
+    return sha1, _workerClassifier.createHist(image)
+
+def _hashFile(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def findImages(imageDir):
+    # Return (relative path, label) pairs for the images in the tree.
+    # Each top-level folder is a label, and contains that label's
+    # images, possibly in subfolders.
+    images = []
+    for label in sorted(os.listdir(imageDir)):
+        labelDir = os.path.join(imageDir, label)
+        if not os.path.isdir(labelDir):
+            continue
+        for dirPath, dirNames, fileNames in os.walk(labelDir):
+            dirNames.sort()
+            for fileName in sorted(fileNames):
+                extension = os.path.splitext(fileName)[1].lower()
+                if extension not in IMAGE_EXTENSIONS:
+                    continue
+                relPath = os.path.relpath(
+                        os.path.join(dirPath, fileName), imageDir)
+                images.append((relPath.replace(os.sep, '/'), label))
+    return images
+
+def _loadManifest(manifestPath, binsPerChannel):
+    if not os.path.exists(manifestPath):
+        return {}
+    with open(manifestPath, 'r') as file:
+        manifest = json.load(file)
+    if manifest.get('binsPerChannel') != binsPerChannel:
+        # Every histogram must be recomputed.
+        return {}
+    return manifest['images']
+
+def _findPreviousHist(references, entry):
+    # Find an image's histogram in the previous model, and copy it so
+    # that the previous model can be replaced.
+    referenceHists = references.get(entry['label'], [])
+    position = entry['reference']
+    if position >= len(referenceHists):
+        return None
+    hist = referenceHists[position]
+    if hist.numOccupiedBins != entry['numOccupiedBins'] or \
+            hist.total != entry['total']:
+        # The model does not match the manifest.
+        return None
+    return HC.CompactHist(numpy.array(hist.indices),
+                          numpy.array(hist.counts), hist.total)
+
+def build(imageDir, modelPath, manifestPath=None, binsPerChannel=256,
+          processes=None, verbose=True):
+
+    if manifestPath is None:
+        manifestPath = modelPath + '.manifest.json'
+
+    # Find the images whose size and modification time are unchanged,
+    # or whose size and content are unchanged, and reuse their
+    # histograms from the previous model.
+    previousEntries = _loadManifest(manifestPath, binsPerChannel)
+    if previousEntries and os.path.exists(modelPath):
+        modelBinsPerChannel, previousReferences, generation = \
+                HC.readModel(modelPath)
+        if modelBinsPerChannel != binsPerChannel:
+            previousReferences = {}
+    else:
+        previousReferences = {}
+    images = findImages(imageDir)
+    hists = {}
+    entries = {}
+    pathsToCompute = []
+    for relPath, label in images:
+        path = os.path.join(imageDir, relPath)
+        stat = os.stat(path)
+        entry = previousEntries.get(relPath)
+        hist = None
+        if entry is not None and entry['label'] == label and \
+                entry['size'] == stat.st_size and \
+                (entry['mtime'] == stat.st_mtime or
+                 entry['sha1'] == _hashFile(path)):
+            # A copy or checkout may have touched the image without
+            # changing it.
+            hist = _findPreviousHist(previousReferences, entry)
+        if hist is None:
+            pathsToCompute.append(relPath)
+        else:
+            hists[relPath] = hist
+            entry = dict(entry)
+            entry['mtime'] = stat.st_mtime
+            entries[relPath] = entry
+    previousReferences = None
+
+    # Compute the other histograms in parallel.
+    numComputed = 0
+    numChanged = 0
+    if pathsToCompute:
+        pool = multiprocessing.Pool(processes, _initWorker,
+                                    (binsPerChannel,))
+        results = pool.imap(
+                _hashAndCreateHist,
+                [os.path.join(imageDir, relPath)
+                 for relPath in pathsToCompute], 4)
+        for relPath, (sha1, hist) in zip(pathsToCompute, results):
+            if hist is None:
+                sys.stderr.write('Failed to decode image from %s\n' % \
+                                 os.path.join(imageDir, relPath))
+                continue
+            stat = os.stat(os.path.join(imageDir, relPath))
+            entry = previousEntries.get(relPath)
+            if entry is not None and entry['sha1'] != sha1:
+                numChanged += 1
+            numComputed += 1
+            hists[relPath] = hist
+            entries[relPath] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': sha1
+            }
+        pool.close()
+        pool.join()
+
+    # Build the model in a stable order, and record the position of
+    # each image's histogram in the manifest.
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    numReferencesByLabel = {}
+    for relPath, label in images:
+        hist = hists.get(relPath)
+        if hist is None:
+            continue
+        classifier.addReferenceHist(hist, label)
+        entry = entries[relPath]
+        entry['label'] = label
+        entry['reference'] = numReferencesByLabel.get(label, 0)
+        entry['numOccupiedBins'] = hist.numOccupiedBins
+        entry['total'] = hist.total
+        numReferencesByLabel[label] = entry['reference'] + 1
+    classifier.serialize(modelPath)
+
+    tempManifestPath = '%s.tmp%d' % (manifestPath, os.getpid())
+    with open(tempManifestPath, 'w') as file:
+        json.dump({'binsPerChannel': binsPerChannel, 'images': entries},
+                  file, indent=1, sort_keys=True)
+    FileUtils.replaceFile(tempManifestPath, manifestPath)
+
+    if verbose:
+        numRemoved = len(set(previousEntries) - set(entries))
+        print('Built %s from %d images in %d labels' % \
+              (modelPath, len(entries), len(numReferencesByLabel)))
+        print('    %d processed (%d with changed content), %d reused, '
+              '%d removed, %d failed' % \
+              (numComputed, numChanged, len(entries) - numComputed,
+               numRemoved, len(pathsToCompute) - numComputed))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Build a histogram classifier from a tree of '
+                        'images, where each top-level folder is a label. '
+                        'On rebuilds, only new or changed images are '
+                        'processed.')
+    parser.add_argument('imageDir')
+    parser.add_argument('modelPath')
+    parser.add_argument('--manifest', dest='manifestPath',
+                        help='defaults to MODELPATH.manifest.json')
+    parser.add_argument('--bins', dest='binsPerChannel', type=int,
+                        default=256)
+    parser.add_argument('--processes', type=int,
+                        help='defaults to one per CPU')
+    args = parser.parse_args()
+    startTime = time.time()
+    build(args.imageDir, args.modelPath, args.manifestPath,
+          args.binsPerChannel, args.processes)
+    print('Finished in %.2f seconds' % (time.time() - startTime))
+
+if __name__ == '__main__':
+    main()
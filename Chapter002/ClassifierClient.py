@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+
+import json
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import socket
+import sys
+import threading
+
+try:
+    # Python 3
+    import http.client as httplib
+except ImportError:
+    # Python 2
+    import httplib
+
+
+DEFAULT_ADDRESS = 'http://127.0.0.1:8765'
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socketPath, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socketPath)
+
+class ClassifierClient(object):
+
+    # Classifies images via a ClassifierDaemon, with the same classify
+    # methods as HistogramClassifier. The address is an http:// URL or
+    # the path of a Unix domain socket. Each thread keeps its own
+    # connection.
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=30.0):
+        self.verbose = False
+        self._address = address
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def address(self):
+        return self._address
+
+    def classify(self, queryImage, queryImageName=None):
+        return self.classifyWithSimilarities(
+                queryImage, queryImageName)[0]
+
+    def classifyWithSimilarities(self, queryImage, queryImageName=None):
+        # Send the image losslessly, so that its histogram is exact.
+        success, data = cv2.imencode(
+                '.png', queryImage, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not success:
+            raise ValueError('Failed to encode image')
+        return self.classifyImageDataWithSimilarities(
+                data.tobytes(), queryImageName)
+
+    def classifyImageDataWithSimilarities(self, imageData,
+                                          queryImageName=None):
+        # Classify an encoded image, such as a downloaded JPEG.
+        return self._classify(imageData, 'application/octet-stream',
+                              queryImageName)
+
+    def classifyFromFile(self, path, queryImageName=None):
+        # The daemon reads the file, so it must be on the same machine.
+        if queryImageName is None:
+            queryImageName = path
+        body = json.dumps({'path': os.path.abspath(path)})
+        return self._classify(body.encode('utf-8'), 'application/json',
+                              queryImageName)[0]
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+    def _classify(self, body, contentType, queryImageName):
+        result = self._request('POST', '/classify', body, contentType)
+        label = result['label']
+        similarities = result['similarities']
+        if self.verbose:
+            print('================================================')
+            if queryImageName is not None:
+                print('Query image:')
+                print('    %s' % queryImageName)
+            print('Mean similarity to reference images by label:')
+            for otherLabel, similarity in similarities.items():
+                print('    %8f  %s' % (similarity, otherLabel))
+            print('================================================')
+        return label, similarities
+
+    def _createConnection(self):
+        if self._address.startswith('http://'):
+            hostAndPort = self._address[len('http://'):].rstrip('/')
+            return httplib.HTTPConnection(hostAndPort,
+                                          timeout=self._timeout)
+        return _UnixHTTPConnection(self._address, self._timeout)
+
+    def _request(self, method, path, body=None, contentType=None):
+        headers = {}
+        if contentType is not None:
+            headers['Content-Type'] = contentType
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            reused = connection is not None
+            if connection is None:
+                connection = self._createConnection()
+                self._local.connection = connection
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                self._local.connection = None
+                if not reused:
+                    raise
+                # The daemon closed the idle connection, so retry once
+                # on a new connection.
+        result = json.loads(data.decode('utf-8'))
+        if response.status != 200:
+            raise RuntimeError('Classifier daemon at %s returned %d: %s' % \
+                               (self._address, response.status,
+                                result.get('error')))
+        return result
+
+def main():
+    address = DEFAULT_ADDRESS
+    if len(sys.argv) > 1:
+        address = sys.argv[1]
+    client = ClassifierClient(address)
+    client.verbose = True
+    client.classifyFromFile('images/communal_apartments_01.jpg')
+    image = cv2.imread('images/dubai_damac_heights.jpg', cv2.IMREAD_COLOR)
+    client.classify(image, 'images/dubai_damac_heights.jpg')
+    print(json.dumps(client.stats(), indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
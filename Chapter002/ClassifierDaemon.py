@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+
+import argparse
+import collections
+import json
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import queue
+    import socketserver
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import Queue as queue
+    import SocketServer as socketserver
+
+import HistogramClassifier as HC
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# The number of recent requests whose latencies are reported.
+LATENCY_WINDOW = 1000
+
+
+class _PendingRequest(object):
+
+    __slots__ = ('image', 'result', 'error', 'event')
+
+    def __init__(self, image):
+        self.image = image
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+class ClassifierDaemon(object):
+
+    # Classifies images for any number of threads. Concurrent requests
+    # are queued and classified in batches by one thread, which owns
+    # the classifier. If processes is not None, batches of more than one
+    # image are classified in a pool of that many processes (0 meaning
+    # one per CPU), which share the memory-mapped model.
+
+    def __init__(self, classifier, maxBatchSize=32, processes=None):
+        self.maxBatchSize = maxBatchSize
+        self.processes = processes
+
+        self._classifier = classifier
+        self._queue = queue.Queue()
+        self._statsLock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._numRequests = 0
+        self._numErrors = 0
+        self._numBatches = 0
+        self._numBatchedImages = 0
+        self._maxQueueDepth = 0
+        self._startTime = time.time()
+
+        self._batchThread = threading.Thread(target=self._runBatches)
+        self._batchThread.daemon = True
+        self._batchThread.start()
+
+    @property
+    def classifier(self):
+        return self._classifier
+
+    def classifyWithSimilarities(self, image):
+        request = _PendingRequest(image)
+        self._queue.put(request)
+        with self._statsLock:
+            self._maxQueueDepth = max(self._maxQueueDepth,
+                                      self._queue.qsize())
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def recordRequest(self, latency, succeeded):
+        with self._statsLock:
+            self._numRequests += 1
+            if succeeded:
+                self._latencies.append(latency)
+            else:
+                self._numErrors += 1
+
+    def stats(self):
+        with self._statsLock:
+            latencies = numpy.array(self._latencies)
+            stats = {
+                'uptimeSeconds': time.time() - self._startTime,
+                'queueDepth': self._queue.qsize(),
+                'maxQueueDepth': self._maxQueueDepth,
+                'requests': self._numRequests,
+                'errors': self._numErrors,
+                'batches': self._numBatches,
+                'meanBatchSize': float(self._numBatchedImages) / \
+                        max(1, self._numBatches)
+            }
+        stats['latencySeconds'] = dict(
+                ('p%d' % percentile,
+                 float(numpy.percentile(latencies, percentile))
+                 if len(latencies) > 0 else None)
+                for percentile in (50, 90, 95, 99))
+        stats['latencySeconds']['count'] = len(latencies)
+        return stats
+
+    def close(self):
+        self._queue.put(None)
+        self._batchThread.join()
+        self._classifier.closeBatchPool()
+
+    def _runBatches(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            # Take any other requests that are waiting.
+            batch = [request]
+            while len(batch) < self.maxBatchSize:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Finish this batch before stopping.
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            try:
+                if self.processes is not None and len(batch) > 1:
+                    results = self._classifier.classifyBatch(
+                            [request.image for request in batch],
+                            self.processes or None)
+                else:
+                    results = [
+                            self._classifier.classifyWithSimilarities(
+                                    request.image)
+                            for request in batch]
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            with self._statsLock:
+                self._numBatches += 1
+                self._numBatchedImages += len(batch)
+            for request in batch:
+                request.image = None
+                request.event.set()
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    # POST /classify with an encoded image as the body, or with a JSON
+    # object such as {"path": "/path/to/image.jpg"}, returns a JSON
+    # object with the label and the similarities by label.
+    # GET /stats returns a JSON object of statistics.
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._sendJson(200, self.server.classifierDaemon.stats())
+        else:
+            self._sendJson(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        startTime = time.time()
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path != '/classify':
+            self._sendJson(404, {'error': 'Not found: %s' % self.path})
+            return
+        daemon = self.server.classifierDaemon
+        succeeded = False
+        try:
+            contentType = self.headers.get('Content-Type', '')
+            if contentType.startswith('application/json'):
+                try:
+                    path = json.loads(body.decode('utf-8'))['path']
+                except (KeyError, TypeError, ValueError) as e:
+                    self._sendJson(400, {
+                        'error': 'Malformed request: %s' % e})
+                    return
+                image = cv2.imread(path, cv2.IMREAD_COLOR)
+                source = path
+            elif body:
+                image = cv2.imdecode(numpy.frombuffer(body, numpy.uint8),
+                                     cv2.IMREAD_COLOR)
+                source = 'the request body'
+            else:
+                image = None
+                source = 'an empty request body'
+            if image is None:
+                self._sendJson(400, {
+                    'error': 'Failed to decode image from %s' % source})
+                return
+            label, similarities = daemon.classifyWithSimilarities(image)
+            self._sendJson(200, {'label': label,
+                                 'similarities': similarities})
+            succeeded = True
+        except Exception as e:
+            self._sendJson(500, {'error': str(e)})
+        finally:
+            daemon.recordRequest(time.time() - startTime, succeeded)
+
+    def _sendJson(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix domain sockets have no client address.
+        if not self.client_address:
+            return 'local'
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _TcpServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def createServer(daemon, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 socketPath=None, verbose=False):
+    # Create a server on a Unix domain socket if a path is given, or
+    # else on a TCP port.
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            # Remove the socket of a previous daemon, unless it is
+            # still listening.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socketPath)
+            except socket.error:
+                os.remove(socketPath)
+            else:
+                raise ValueError('Another daemon is listening on %s' % \
+                                 socketPath)
+            finally:
+                probe.close()
+        server = _UnixServer(socketPath, _RequestHandler)
+    else:
+        server = _TcpServer((host, port), _RequestHandler)
+    server.classifierDaemon = daemon
+    server.verbose = verbose
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Load a classifier once and classify images for '
+                        'other processes, over HTTP on localhost or on a '
+                        'Unix domain socket. POST /classify with image '
+                        'bytes or {"path": PATH}; GET /stats for queue '
+                        'depth and latency percentiles.')
+    parser.add_argument('modelPath', nargs='?', default='classifier.hist')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', dest='socketPath',
+                        help='listen on this Unix domain socket instead '
+                             'of a TCP port')
+    parser.add_argument('--max-batch-size', dest='maxBatchSize', type=int,
+                        default=32)
+    parser.add_argument('--processes', type=int,
+                        help='classify batches in this many processes '
+                             '(0 for one per CPU)')
+    parser.add_argument('--bin-index', dest='useBinIndex',
+                        action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    binsPerChannel = HC.readModel(args.modelPath)[0]
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    classifier.useBinIndex = args.useBinIndex
+    classifier.deserialize(args.modelPath)
+    daemon = ClassifierDaemon(classifier, args.maxBatchSize,
+                              args.processes)
+    server = createServer(daemon, args.host, args.port, args.socketPath,
+                          args.verbose)
+    if args.socketPath is not None:
+        print('Classifying with %s on %s' % (args.modelPath,
+                                             args.socketPath))
+    else:
+        print('Classifying with %s on http://%s:%d' % \
+              (args.modelPath, args.host, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        if args.socketPath is not None and \
+                os.path.exists(args.socketPath):
+            os.remove(args.socketPath)
+
+if __name__ == '__main__':
+    main()
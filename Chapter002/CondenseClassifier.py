@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+
+import argparse
+import time
+
+import HistogramClassifier as HC
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Condense a classifier to a representative '
+                        'subset of each label\'s references, chosen by '
+                        'k-medoids, so that it loads and classifies '
+                        'faster. The subset is bounded by a number of '
+                        'references per label, by the loss of '
+                        'leave-one-out accuracy on the existing '
+                        'references, or by both.')
+    parser.add_argument('srcPath')
+    parser.add_argument('dstPath')
+    parser.add_argument('--max-references', dest='maxReferencesPerLabel',
+                        type=int,
+                        help='maximum number of references per label')
+    parser.add_argument('--max-accuracy-loss', dest='maxAccuracyLoss',
+                        type=float,
+                        help='maximum loss of leave-one-out accuracy, '
+                             'as a fraction, such as 0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.maxReferencesPerLabel is None and \
+            args.maxAccuracyLoss is None:
+        parser.error('Specify --max-references, --max-accuracy-loss or '
+                     'both')
+
+    binsPerChannel = HC.readModel(args.srcPath)[0]
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    classifier.deserialize(args.srcPath)
+    startTime = time.time()
+    result = classifier.condense(args.maxReferencesPerLabel,
+                                 args.maxAccuracyLoss, args.seed)
+    classifier.serialize(args.dstPath)
+    print('Condensed %s to %s in %.2f seconds' % \
+          (args.srcPath, args.dstPath, time.time() - startTime))
+    print('    %d references per label, %d of %d references kept' % \
+          (result['referencesPerLabel'], result['referencesAfter'],
+           result['referencesBefore']))
+    print('    Leave-one-out accuracy %.2f%% before, %.2f%% after' % \
+          (100.0 * result['accuracyBefore'],
+           100.0 * result['accuracyAfter']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+
+import HistogramClassifier
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write(
+                'Usage: %s SRC.mat DST.hist\n'
+                'Convert a classifier from the MAT format to the '
+                'memory-mapped format.\n' % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    srcPath, dstPath = sys.argv[1:]
+    HistogramClassifier.convertModel(srcPath, dstPath)
+    print('Converted %s to %s' % (srcPath, dstPath))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import numpy # Hint to PyInstaller
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+import HistogramClassifier as HC
+from ImageSearchSession import ImageSearchSession, SearchResultCache, \
+        SEARCHES_PER_SECOND
+import RequestScheduler
+import RequestsUtils
+
+
+class Crawler(object):
+
+    # Searches for images, downloads them and classifies them, without
+    # a GUI, and writes one line of JSON per result. The stages run
+    # concurrently: one thread pages through the search results, a pool
+    # of threads downloads the images, and a pool of processes decodes
+    # and classifies them. The stages are connected by bounded queues,
+    # so a slow stage blocks the stages before it, and memory use does
+    # not grow with the number of results.
+
+    def __init__(self, classifier, output, resultsPerQuery=50, pageSize=50,
+                 numDownloadThreads=32, processes=None, batchSize=8,
+                 targetImageSize=768,
+                 maxImageBytes=RequestsUtils.MAX_CONTENT_BYTES):
+        self.resultsPerQuery = resultsPerQuery
+        self.pageSize = pageSize
+        self.numDownloadThreads = numDownloadThreads
+        # Each classifying thread waits for one batch at a time, so
+        # there is one thread per process to keep every process busy.
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batchSize = batchSize
+        # JPEGs are decoded at a reduced resolution whose larger
+        # dimension is still at least this size, or at full resolution
+        # if this is None.
+        self.targetImageSize = targetImageSize
+        self.maxImageBytes = maxImageBytes
+
+        self._classifier = classifier
+        self._output = output
+        self._session = ImageSearchSession()
+        self._outputLock = threading.Lock()
+        self._statsLock = threading.Lock()
+        self._stats = collections.Counter()
+        self._labelCounts = collections.Counter()
+
+    @property
+    def session(self):
+        return self._session
+
+    def run(self, queries):
+        # Crawl the queries, which may be any iterable, such as the
+        # lines of a file, and return a dict of statistics.
+        startTime = time.time()
+        downloadQueue = queue.Queue(self.numDownloadThreads * 2)
+        classifyQueue = queue.Queue(self.processes * self.batchSize * 2)
+
+        # Start the process pool before any thread uses it.
+        self._classifier.classifyImageDataBatch([], self.processes)
+
+        downloadThreads = self._startThreads(
+                self.numDownloadThreads, self._download,
+                (downloadQueue, classifyQueue))
+        classifyThreads = self._startThreads(
+                self.processes, self._classify, (classifyQueue,))
+        try:
+            self._search(queries, downloadQueue)
+        finally:
+            # Stop each stage once the stage before it has finished.
+            for thread in downloadThreads:
+                downloadQueue.put(None)
+            for thread in downloadThreads:
+                thread.join()
+            for thread in classifyThreads:
+                classifyQueue.put(None)
+            for thread in classifyThreads:
+                thread.join()
+            self._classifier.closeBatchPool()
+
+        elapsedSeconds = time.time() - startTime
+        with self._statsLock:
+            stats = dict(self._stats)
+            stats['labels'] = dict(self._labelCounts)
+        stats['elapsedSeconds'] = elapsedSeconds
+        stats['resultsPerSecond'] = \
+                stats.get('results', 0) / max(elapsedSeconds, 1e-6)
+        stats['connections'] = RequestsUtils.connectionStats()
+        scheduler = RequestsUtils.getScheduler()
+        if scheduler is not None:
+            stats['scheduler'] = scheduler.stats()
+        stats['searchResultCache'] = \
+                self._session.searchResultCache.stats()
+        return stats
+
+    def _startThreads(self, count, target, args):
+        threads = []
+        for i in range(count):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _count(self, name, amount=1):
+        with self._statsLock:
+            self._stats[name] += amount
+
+    def _search(self, queries, downloadQueue):
+        session = self._session
+        for query in queries:
+            query = query.strip()
+            if not query:
+                continue
+            self._count('queries')
+            rank = 0
+            offset = 0
+            while rank < self.resultsPerQuery:
+                session.search(query,
+                               min(self.pageSize,
+                                   self.resultsPerQuery - rank),
+                               offset)
+                numResults = min(session.numResultsReceived,
+                                 self.resultsPerQuery - rank)
+                if numResults == 0:
+                    break
+                self._count('pages')
+                for index in range(numResults):
+                    # This blocks while the downloads are behind.
+                    downloadQueue.put((query, rank, session.getUrl(index)))
+                    rank += 1
+                offset += session.numResultsRequested
+                if offset >= session.numResultsAvailable:
+                    break
+
+    def _download(self, downloadQueue, classifyQueue):
+        while True:
+            item = downloadQueue.get()
+            if item is None:
+                return
+            query, rank, url = item
+            startTime = time.time()
+            imageData = RequestsUtils.getContent(url, self.maxImageBytes)
+            downloadSeconds = time.time() - startTime
+            record = {
+                'query': query,
+                'rank': rank,
+                'url': url,
+                'downloadSeconds': downloadSeconds
+            }
+            if imageData is None:
+                record['error'] = 'Failed to download image'
+                self._write([record])
+                continue
+            record['imageBytes'] = len(imageData)
+            self._count('bytesDownloaded', len(imageData))
+            imreadFlags = RequestsUtils.chooseImreadFlags(
+                    imageData, self.targetImageSize)
+            # This blocks while the classification is behind.
+            classifyQueue.put((record, imageData, imreadFlags))
+
+    def _classify(self, classifyQueue):
+        stop = False
+        while not stop:
+            item = classifyQueue.get()
+            if item is None:
+                return
+            # Take any other images that are waiting.
+            batch = [item]
+            while len(batch) < self.batchSize:
+                try:
+                    item = classifyQueue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Finish this batch before stopping.
+                    stop = True
+                    break
+                batch.append(item)
+            records = [record for record, imageData, imreadFlags in batch]
+            try:
+                results = self._classifier.classifyImageDataBatch(
+                        [imageData for record, imageData, imreadFlags
+                         in batch],
+                        self.processes,
+                        [imreadFlags for record, imageData, imreadFlags
+                         in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            batch = None
+            for record, result in zip(records, results):
+                if result is None:
+                    record['error'] = 'Failed to decode image'
+                elif isinstance(result, Exception):
+                    record['error'] = 'Failed to classify image: %s' % \
+                            result
+                else:
+                    record['label'], record['similarities'] = result
+            self._write(records)
+
+    def _write(self, records):
+        lines = ''.join(json.dumps(record, sort_keys=True) + '\n'
+                        for record in records)
+        with self._outputLock:
+            self._output.write(lines)
+            self._output.flush()
+        with self._statsLock:
+            for record in records:
+                self._stats['results'] += 1
+                if 'error' in record:
+                    self._stats['errors'] += 1
+                else:
+                    self._labelCounts[record['label']] += 1
+
+def _readQueries(path):
+    # Yield the lines of a file, or of stdin if the path is '-', without
+    # reading the whole file.
+    if path == '-':
+        for line in sys.stdin:
+            yield line
+        return
+    with open(path, 'r') as file:
+        for line in file:
+            yield line
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Search for images, download them concurrently and '
+                        'classify them in a pool of processes, writing '
+                        'one JSON object per result. Requires '
+                        'BING_SEARCH_KEY. Statistics are written to '
+                        'stderr at the end.')
+    parser.add_argument('queries', nargs='*',
+                        help='search queries, in addition to those in '
+                             '--queries-file')
+    parser.add_argument('--queries-file', dest='queriesPath',
+                        help='a file of queries, one per line, or - for '
+                             'stdin')
+    parser.add_argument('--model', dest='modelPath',
+                        default='classifier.hist')
+    parser.add_argument('--output', '-o',
+                        help='write the JSON lines here instead of to '
+                             'stdout')
+    parser.add_argument('--results-per-query', dest='resultsPerQuery',
+                        type=int, default=50)
+    parser.add_argument('--page-size', dest='pageSize', type=int,
+                        default=50)
+    parser.add_argument('--download-threads', dest='numDownloadThreads',
+                        type=int, default=32)
+    parser.add_argument('--max-requests-per-host',
+                        dest='maxRequestsPerHost', type=int,
+                        default=RequestScheduler.MAX_REQUESTS_PER_HOST,
+                        help='limit the concurrent downloads from each '
+                             'image host')
+    parser.add_argument('--searches-per-second', dest='searchesPerSecond',
+                        type=float, default=SEARCHES_PER_SECOND,
+                        help='limit the rate of searches to the API\'s '
+                             'quota (default: %(default)s)')
+    parser.add_argument('--processes', type=int,
+                        help='number of classifying processes (default: '
+                             'one per CPU)')
+    parser.add_argument('--batch-size', dest='batchSize', type=int,
+                        default=8)
+    parser.add_argument('--target-size', dest='targetImageSize', type=int,
+                        default=768,
+                        help='decode JPEGs at a reduced resolution whose '
+                             'larger dimension is at least this, or at '
+                             'full resolution if 0')
+    parser.add_argument('--search-cache', dest='searchCacheDir',
+                        help='keep pages of search results in this '
+                             'directory')
+    parser.add_argument('--image-cache', dest='imageCacheDir',
+                        help='keep downloaded images in this directory')
+    parser.add_argument('--bin-index', dest='useBinIndex',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if not args.queries and args.queriesPath is None:
+        parser.error('Give queries or --queries-file')
+    queries = iter(args.queries)
+    if args.queriesPath is not None:
+        queries = itertools.chain(queries,
+                                  _readQueries(args.queriesPath))
+
+    # Keep a connection for each concurrent request to a host.
+    RequestsUtils.setScheduler(RequestScheduler.RequestScheduler(
+            args.maxRequestsPerHost))
+    RequestsUtils.configureTransport(
+            maxConnectionsPerHost=max(RequestsUtils.MAX_CONNECTIONS_PER_HOST,
+                                      args.maxRequestsPerHost))
+    if args.imageCacheDir is not None:
+        RequestsUtils.setDiskCache(
+                RequestsUtils.DiskCache(args.imageCacheDir))
+
+    binsPerChannel = HC.readModel(args.modelPath)[0]
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    classifier.useBinIndex = args.useBinIndex
+    classifier.deserialize(args.modelPath)
+
+    if args.output:
+        output = open(args.output, 'w')
+    else:
+        output = sys.stdout
+    crawler = Crawler(classifier, output, args.resultsPerQuery,
+                      args.pageSize, args.numDownloadThreads,
+                      args.processes, args.batchSize,
+                      args.targetImageSize or None)
+    crawler.session.searchesPerSecond = args.searchesPerSecond
+    if args.searchCacheDir is not None:
+        crawler.session.searchResultCache = \
+                SearchResultCache(args.searchCacheDir)
+    try:
+        stats = crawler.run(queries)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    json.dump(stats, sys.stderr, indent=2, sort_keys=True)
+    sys.stderr.write('\n')
+
+if __name__ == '__main__':
+    main()
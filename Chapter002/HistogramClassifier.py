@@ -3,94 +3,1461 @@
 
 import numpy # Hint to PyInstaller
 import cv2
-import scipy.io
-import scipy.sparse
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import FileUtils
+
+
+# The key under which a serialized model records its bin layout.
+# Models without this key were trained with 256 bins per channel.
+BINS_PER_CHANNEL_KEY = 'binsPerChannel'
+
+# Models in the memory-mapped format start with this signature.
+MAPPED_MODEL_MAGIC = b'HISTMAP1'
+
+# Arrays in the memory-mapped format start at multiples of this size.
+MAPPED_MODEL_ALIGNMENT = 64
+
+# Each record in a segment file starts with this signature, followed by
+# the payload's length and CRC-32.
+SEGMENT_RECORD_MAGIC = b'HSEG'
+_SEGMENT_RECORD_HEADER = struct.Struct('<4sII')
+
+# Each record's payload starts with the bins per channel, the length of
+# the label, the total count, and the number of occupied bins.
+_SEGMENT_PAYLOAD_HEADER = struct.Struct('<HIdI')
+
+# The default number of cells along each side of a region of a grid,
+# and the default cell size, in pixels, for sliding windows, which are
+# measured in cells.
+GRID_CELLS_PER_REGION = 8
+WINDOW_CELL_SIZE = 16
+
+class CompactHist(object):
+    # A sparse histogram, stored as the indices of its occupied bins,
+    # the pixel count in each of those bins, and the total pixel count.
+    # Normalization is deferred until histograms are compared.
+    # Histograms from models that only stored normalized values have
+    # floating-point counts instead.
+    # A packed histogram stores the low 16 bits of each index, plus the
+    # position where each value of the higher bits starts, and unpacks
+    # its indices when they are read. With uint16 counts, that is 4
+    # bytes per occupied bin instead of 6 with int32 indices.
+
+    __slots__ = ('_indices', '_lowIndices', '_highStarts', 'counts',
+                 'total')
+
+    def __init__(self, indices, counts, total):
+        # The arrays are kept as they are, so that they may be views of
+        # a memory-mapped model.
+        self._indices = indices
+        self._lowIndices = None
+        self._highStarts = None
+        self.counts = counts
+        self.total = total
+
+    @property
+    def indices(self):
+        if self._indices is not None:
+            return self._indices
+        indices = self._lowIndices.astype(numpy.int32)
+        if self._highStarts is not None:
+            indices += numpy.repeat(
+                    numpy.arange(len(self._highStarts) - 1,
+                                 dtype=numpy.int32) << 16,
+                    numpy.diff(self._highStarts))
+        return indices
+
+    @property
+    def numOccupiedBins(self):
+        return len(self.counts)
+
+    def packed(self):
+        # Return a packed copy of the histogram, which shares its
+        # counts. Histograms that are already packed, or that are views
+        # of a memory-mapped model, whose pages are shared, are
+        # returned as they are.
+        if self._indices is None or \
+                isinstance(self._indices, numpy.memmap):
+            return self
+        indices = numpy.asarray(self._indices)
+        hist = CompactHist(None, self.counts, self.total)
+        hist._lowIndices = (indices & 0xffff).astype(numpy.uint16)
+        if len(indices) > 0 and indices[-1] > 0xffff:
+            hist._highStarts = numpy.searchsorted(
+                    indices,
+                    numpy.arange((int(indices[-1]) >> 16) + 2) << 16
+                    ).astype(numpy.int32)
+        return hist
+
+    @staticmethod
+    def fromCounts(indices, counts, total=None):
+        # Choose the narrowest type that holds the counts exactly.
+        indices = numpy.asarray(indices, numpy.int32)
+        counts = numpy.asarray(counts)
+        if counts.dtype.kind == 'f' and \
+                numpy.any(counts != numpy.rint(counts)):
+            counts = counts.astype(numpy.float32)
+        elif len(counts) == 0 or counts.max() < 65536:
+            counts = counts.astype(numpy.uint16)
+        else:
+            counts = counts.astype(numpy.uint32)
+        if total is None:
+            total = counts.sum(dtype=numpy.float64)
+            if counts.dtype.kind == 'u':
+                total = int(total)
+        return CompactHist(indices, counts, total)
+
+    @property
+    def nbytes(self):
+        if self._indices is not None:
+            return self._indices.nbytes + self.counts.nbytes
+        nbytes = self._lowIndices.nbytes + self.counts.nbytes
+        if self._highStarts is not None:
+            nbytes += self._highStarts.nbytes
+        return nbytes
+
+    def toSparseColumn(self, numBins):
+        # scipy is imported only when needed, because importing it is
+        # slow and most uses of the memory-mapped format do not need it.
+        import scipy.sparse
+        return scipy.sparse.csc_matrix(
+                (self.counts.astype(numpy.float64),
+                 self.indices, [0, self.numOccupiedBins]),
+                shape=(numBins, 1))
+
+    @staticmethod
+    def fromSparseColumn(column):
+        import scipy.sparse
+        column = scipy.sparse.csc_matrix(column)
+        column.sum_duplicates()
+        column.eliminate_zeros()
+        return CompactHist.fromCounts(column.indices, column.data)
+
+def _widenCounts(counts):
+    if counts.dtype.kind == 'f':
+        return counts.astype(numpy.float64)
+    return counts.astype(numpy.int64)
+
+def intersectSparseHists(histA, histB):
+    # Compute the same similarity as cv2.HISTCMP_INTERSECT on the
+    # normalized histograms, but visit only the occupied bins.
+    # Bins that are empty in either histogram contribute nothing.
+    if histA.numOccupiedBins > histB.numOccupiedBins:
+        histA, histB = histB, histA
+    indicesA, indicesB = histA.indices, histB.indices
+    if len(indicesA) == 0:
+        return 0.0
+    # Look up the smaller histogram's bins in the larger histogram.
+    # Both index arrays are sorted.
+    positions = numpy.searchsorted(indicesB, indicesA)
+    positions[positions == len(indicesB)] = 0
+    matches = indicesB[positions] == indicesA
+    countsA = _widenCounts(histA.counts[matches])
+    countsB = _widenCounts(histB.counts[positions[matches]])
+    # Scale both sets of counts to a common total, so that integer
+    # counts are compared exactly. Normalize only at the end.
+    overlap = numpy.minimum(countsA * histB.total,
+                            countsB * histA.total).sum()
+    return float(overlap) / (float(histA.total) * float(histB.total))
+
+def writeMappedModel(path, binsPerChannel, references, generation=0):
+    # Write a flat header, followed by contiguous arrays for each
+    # label: the offset of each reference's bins, the total count of
+    # each reference, and the bin indices and counts of all references.
+    # Every array is aligned so that it can be viewed in place.
+    labels = []
+    arrays = []
+    position = [0]
+    def addArray(array):
+        array = numpy.ascontiguousarray(array)
+        descriptor = [position[0], array.dtype.str, len(array)]
+        arrays.append((position[0], array))
+        position[0] += -(-array.nbytes // MAPPED_MODEL_ALIGNMENT) * \
+                MAPPED_MODEL_ALIGNMENT
+        return descriptor
+    for label, referenceHists in references.items():
+        lengths = [hist.numOccupiedBins for hist in referenceHists]
+        countsType = numpy.result_type(
+                *[hist.counts.dtype for hist in referenceHists])
+        labels.append({
+            'label': label,
+            'offsets': addArray(numpy.concatenate(
+                    [[0], numpy.cumsum(lengths)]).astype(numpy.int64)),
+            'totals': addArray(numpy.array(
+                    [hist.total for hist in referenceHists],
+                    numpy.float64)),
+            'indices': addArray(numpy.concatenate(
+                    [hist.indices for hist in referenceHists]).astype(
+                            numpy.int32)),
+            'counts': addArray(numpy.concatenate(
+                    [hist.counts for hist in referenceHists]).astype(
+                            countsType))
+        })
+    header = json.dumps({
+        'binsPerChannel': binsPerChannel,
+        'generation': generation,
+        'labels': labels
+    }).encode('utf-8')
+    headerSize = len(MAPPED_MODEL_MAGIC) + 8 + len(header)
+    dataStart = -(-headerSize // MAPPED_MODEL_ALIGNMENT) * \
+            MAPPED_MODEL_ALIGNMENT
+    # Write to a temporary file and then replace the model, so that
+    # readers never see a partial model and existing mappings of the
+    # old model stay valid.
+    tempPath = '%s.tmp%d' % (path, os.getpid())
+    with open(tempPath, 'wb') as file:
+        file.write(MAPPED_MODEL_MAGIC)
+        file.write(struct.pack('<Q', len(header)))
+        file.write(header)
+        for offset, array in arrays:
+            file.seek(dataStart + offset)
+            file.write(array.tobytes())
+        file.truncate(dataStart + position[0])
+        file.flush()
+        os.fsync(file.fileno())
+    FileUtils.replaceFile(tempPath, path)
+
+def isMappedModel(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MAPPED_MODEL_MAGIC)) == MAPPED_MODEL_MAGIC
+
+def _readMappedModel(path):
+    with open(path, 'rb') as file:
+        file.seek(len(MAPPED_MODEL_MAGIC))
+        headerLength, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(headerLength).decode('utf-8'))
+    headerSize = len(MAPPED_MODEL_MAGIC) + 8 + headerLength
+    dataStart = -(-headerSize // MAPPED_MODEL_ALIGNMENT) * \
+            MAPPED_MODEL_ALIGNMENT
+    # Map the file instead of reading it. Pages are loaded on demand
+    # and shared between processes via the OS cache.
+    data = numpy.memmap(path, numpy.uint8, 'r')
+    def viewArray(descriptor):
+        offset, dtype, length = descriptor
+        dtype = numpy.dtype(dtype)
+        start = dataStart + offset
+        return data[start:start + length * dtype.itemsize].view(dtype)
+    references = {}
+    for entry in header['labels']:
+        offsets = numpy.array(viewArray(entry['offsets']))
+        totals = numpy.array(viewArray(entry['totals']))
+        indices = viewArray(entry['indices'])
+        counts = viewArray(entry['counts'])
+        if counts.dtype.kind == 'u':
+            totals = [int(total) for total in totals]
+        else:
+            totals = [float(total) for total in totals]
+        references[entry['label']] = [
+                CompactHist(indices[offsets[i]:offsets[i + 1]],
+                            counts[offsets[i]:offsets[i + 1]],
+                            totals[i])
+                for i in range(len(totals))]
+    return header['binsPerChannel'], references, \
+            header.get('generation', 0)
+
+def _readMatModel(path):
+    import scipy.io
+    file = open(path, 'rb')
+    model = scipy.io.loadmat(file)
+    binsPerChannel = 256
+    if BINS_PER_CHANNEL_KEY in model:
+        binsPerChannel = int(model.pop(BINS_PER_CHANNEL_KEY).flat[0])
+    references = {}
+    for key, value in model.items():
+        if not isinstance(value, numpy.ndarray):
+            # This entry is serialization metadata so skip it.
+            continue
+        # The serializer wraps the data in an extra array.
+        # Unwrap the data and compact it. Older models store
+        # normalized values instead of counts.
+        references[key] = [
+                CompactHist.fromSparseColumn(column).packed()
+                for column in value[0]]
+    return binsPerChannel, references
+
+def readModelGeneration(path):
+    # Return the generation of segments that were compacted into the
+    # model. Segments of this generation or later are pending.
+    if isMappedModel(path):
+        return _readMappedModel(path)[2]
+    return 0
+
+def readModel(path):
+    # Return the bins per channel and the reference histograms by
+    # label, from a model in either the memory-mapped format or the
+    # MAT format, plus any pending segments.
+    # Also return the model's generation. A model records the
+    # generation of segments that were compacted into it, and
+    # segments of that generation or later are pending. The returned
+    # generation is the first one that has no segment yet.
+    if isMappedModel(path):
+        binsPerChannel, references, generation = _readMappedModel(path)
+    else:
+        binsPerChannel, references = _readMatModel(path)
+        generation = 0
+    for generation, pendingPath in listSegments(path, generation):
+        for record in readSegment(pendingPath)[0]:
+            recordBinsPerChannel, label, hist = record
+            if recordBinsPerChannel != binsPerChannel:
+                raise ValueError(
+                        'The segment at %s has %d bins per channel but '
+                        'the model has %d' % \
+                        (pendingPath, recordBinsPerChannel,
+                         binsPerChannel))
+            references.setdefault(label, []).append(hist)
+        generation += 1
+    return binsPerChannel, references, generation
+
+def segmentPath(modelPath, generation):
+    return '%s.%d.seg' % (modelPath, generation)
+
+def listSegments(modelPath, minGeneration=0):
+    # Return (generation, path) pairs for the model's segments, in
+    # order of generation.
+    dirPath, modelName = os.path.split(os.path.abspath(modelPath))
+    prefix = modelName + '.'
+    segments = []
+    for name in os.listdir(dirPath):
+        if not name.startswith(prefix) or not name.endswith('.seg'):
+            continue
+        generation = name[len(prefix):-len('.seg')]
+        if generation.isdigit() and int(generation) >= minGeneration:
+            segments.append(
+                    (int(generation), os.path.join(dirPath, name)))
+    segments.sort()
+    return segments
+
+def encodeSegmentRecord(binsPerChannel, label, hist):
+    labelBytes = label.encode('utf-8')
+    payload = b''.join([
+        _SEGMENT_PAYLOAD_HEADER.pack(
+                binsPerChannel, len(labelBytes), float(hist.total),
+                hist.numOccupiedBins),
+        labelBytes,
+        numpy.asarray(hist.indices, '<i4').tobytes(),
+        numpy.asarray(hist.counts, '<f8').tobytes()
+    ])
+    return _SEGMENT_RECORD_HEADER.pack(
+            SEGMENT_RECORD_MAGIC, len(payload),
+            zlib.crc32(payload) & 0xffffffff) + payload
+
+def readSegment(path):
+    # Return the segment's complete records as (bins per channel,
+    # label, histogram) tuples, plus the length of the file that they
+    # span. Reading stops at the first torn or corrupt record, since
+    # it was never completely appended.
+    with open(path, 'rb') as file:
+        data = file.read()
+    records = []
+    position = 0
+    while position + _SEGMENT_RECORD_HEADER.size <= len(data):
+        magic, payloadLength, crc = _SEGMENT_RECORD_HEADER.unpack_from(
+                data, position)
+        payloadStart = position + _SEGMENT_RECORD_HEADER.size
+        payload = data[payloadStart:payloadStart + payloadLength]
+        if magic != SEGMENT_RECORD_MAGIC or \
+                len(payload) != payloadLength or \
+                zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        binsPerChannel, labelLength, total, numOccupied = \
+                _SEGMENT_PAYLOAD_HEADER.unpack_from(payload)
+        offset = _SEGMENT_PAYLOAD_HEADER.size
+        label = payload[offset:offset + labelLength].decode('utf-8')
+        offset += labelLength
+        indices = numpy.frombuffer(payload, '<i4', numOccupied, offset)
+        offset += indices.nbytes
+        counts = numpy.frombuffer(payload, '<f8', numOccupied, offset)
+        hist = CompactHist.fromCounts(indices, counts)
+        if hist.counts.dtype.kind == 'u':
+            hist.total = int(total)
+        else:
+            hist.total = total
+        records.append((binsPerChannel, label, hist.packed()))
+        position = payloadStart + payloadLength
+    return records, position
+
+def convertModel(srcPath, dstPath):
+    # Convert a model in the MAT format to the memory-mapped format.
+    binsPerChannel, references, generation = readModel(srcPath)
+    writeMappedModel(dstPath, binsPerChannel, references)
+
+class _BinIndex(object):
+    # An inverted index from occupied histogram bins to posting lists
+    # of (reference ID, count).
+    # References are added in blocks. Each block is a sparse matrix
+    # with one row per bin that is occupied in the block, and one
+    # column per reference. When there are too many blocks, they are
+    # merged into one. Several threads may query the index at once.
+
+    MAX_BLOCKS = 8
+
+    def __init__(self, numBins):
+        self._numBins = numBins
+        self._labels = []
+        self._labelIDs = {}
+        self._referenceLabelIDs = []
+        self._numReferences = 0
+        self._blocks = []
+        self._pendingHists = []
+        self._lock = threading.Lock()
+
+    def add(self, hist, label):
+        with self._lock:
+            labelID = self._labelIDs.get(label)
+            if labelID is None:
+                labelID = len(self._labels)
+                self._labelIDs[label] = labelID
+                self._labels.append(label)
+            self._referenceLabelIDs.append(labelID)
+            self._pendingHists.append(hist)
+
+    def _flushAndSnapshot(self):
+        # Flush the pending references and return the blocks, the number
+        # of references, the labels and each reference's label ID, all
+        # under the lock, so that concurrent queries neither flush the
+        # same references twice nor see a partial flush.
+        with self._lock:
+            self._flush()
+            return list(self._blocks), self._numReferences, \
+                    list(self._labels), list(self._referenceLabelIDs)
+
+    def _flush(self):
+        if self._pendingHists:
+            hists = self._pendingHists
+            self._blocks.append(self._createBlock(
+                    self._numReferences,
+                    numpy.concatenate([h.indices for h in hists]),
+                    numpy.repeat(numpy.arange(len(hists)),
+                                 [h.numOccupiedBins for h in hists]),
+                    numpy.concatenate(
+                            [h.counts.astype(numpy.float64)
+                             for h in hists]),
+                    numpy.array([h.total for h in hists],
+                                numpy.float64)))
+            self._numReferences += len(hists)
+            self._pendingHists = []
+        if len(self._blocks) > self.MAX_BLOCKS:
+            bins, columns, counts = [], [], []
+            for start, blockBins, postings, totals in self._blocks:
+                postings = postings.tocoo()
+                bins.append(blockBins[postings.row])
+                columns.append(postings.col + start)
+                counts.append(postings.data)
+            self._blocks = [self._createBlock(
+                    0, numpy.concatenate(bins),
+                    numpy.concatenate(columns),
+                    numpy.concatenate(counts),
+                    numpy.concatenate(
+                            [block[3] for block in self._blocks]))]
+
+    def _createBlock(self, start, bins, columns, counts, totals):
+        # Convert columns of bins to rows of postings, keeping only the
+        # occupied bins.
+        import scipy.sparse
+        bins, rows = numpy.unique(bins, return_inverse=True)
+        postings = scipy.sparse.csr_matrix(
+                (counts, (rows, columns)),
+                shape=(len(bins), len(totals)))
+        return start, bins, postings, totals
+
+    def similarities(self, queryHist):
+        blocks, numReferences, labels, referenceLabelIDs = \
+                self._flushAndSnapshot()
+        scores = self._scoreBlocks(queryHist, blocks, numReferences)
+        # Average the scores by label.
+        labelIDs = numpy.asarray(referenceLabelIDs)
+        sums = numpy.bincount(labelIDs, scores, len(labels))
+        counts = numpy.bincount(labelIDs, None, len(labels))
+        return dict(zip(labels, sums / counts))
+
+    def referenceSimilarities(self, queryHist):
+        # Return the similarity to each reference, in the order in which
+        # the references were added.
+        blocks, numReferences = self._flushAndSnapshot()[:2]
+        return self._scoreBlocks(queryHist, blocks, numReferences)
+
+    def _scoreBlocks(self, queryHist, blocks, numReferences):
+        queryBins = queryHist.indices
+        queryCounts = queryHist.counts.astype(numpy.float64)
+        queryTotal = float(queryHist.total)
+        scores = numpy.zeros(numReferences)
+        for start, bins, postings, totals in blocks:
+            if len(bins) == 0 or len(queryBins) == 0:
+                continue
+            # Find the posting lists of the query's occupied bins.
+            positions = numpy.searchsorted(bins, queryBins)
+            positions[positions == len(bins)] = 0
+            matches = bins[positions] == queryBins
+            rows = postings[positions[matches]]
+            # Accumulate the intersection for every reference at once.
+            # As in intersectSparseHists, scale the counts to a common
+            # total and normalize at the end.
+            overlaps = numpy.minimum(
+                    rows.data * queryTotal,
+                    numpy.repeat(queryCounts[matches],
+                                 numpy.diff(rows.indptr)) * \
+                            totals[rows.indices])
+            scores[start:start + len(totals)] += numpy.bincount(
+                    rows.indices, overlaps, len(totals)) / \
+                    (totals * queryTotal)
+        return scores
+
+def _chooseKMedoids(distances, k, random, maxIterations=100):
+    # Return the sorted positions of k medoids, chosen by alternating
+    # between assigning each item to its nearest medoid and moving each
+    # medoid to the member of its cluster with the least total
+    # distance to the other members. The medoids are initialized as in
+    # k-means++.
+    n = len(distances)
+    if k >= n:
+        return numpy.arange(n)
+    medoids = [random.randint(n)]
+    nearest = distances[medoids[0]].copy()
+    for i in range(1, k):
+        weights = numpy.maximum(nearest, 0.0) ** 2
+        weights[medoids] = 0.0
+        if weights.sum() > 0.0:
+            medoid = random.choice(n, p=weights / weights.sum())
+        else:
+            # The remaining items duplicate the medoids.
+            medoid = random.choice(numpy.setdiff1d(numpy.arange(n),
+                                                   medoids))
+        medoids.append(medoid)
+        nearest = numpy.minimum(nearest, distances[medoid])
+    medoids = numpy.array(medoids)
+    for iteration in range(maxIterations):
+        assignments = numpy.argmin(distances[:, medoids], axis=1)
+        # Each medoid belongs to its own cluster, even if it has a
+        # duplicate.
+        assignments[medoids] = numpy.arange(k)
+        newMedoids = medoids.copy()
+        for cluster in range(k):
+            members = numpy.flatnonzero(assignments == cluster)
+            costs = distances[numpy.ix_(members, members)].sum(axis=0)
+            newMedoids[cluster] = members[numpy.argmin(costs)]
+        if (newMedoids == medoids).all():
+            break
+        medoids = newMedoids
+    return numpy.unique(medoids)
+
+class IntegralHist(object):
+    # A summed-area table of histograms over a grid of square cells, so
+    # that the histogram of any rectangle of cells is found in constant
+    # time, regardless of the rectangle's area. The bins are laid out as
+    # in HistogramClassifier.createHist, with ranges of [0, 256].
+
+    def __init__(self, image, binsPerChannel=8, cellSize=16):
+        if binsPerChannel < 1 or 256 % binsPerChannel != 0:
+            raise ValueError(
+                    'binsPerChannel must be a power of 2 from 1 to 256, '
+                    'not %r' % binsPerChannel)
+        h, w = image.shape[:2]
+        numRows = -(-h // cellSize)
+        numCols = -(-w // cellSize)
+        numBins = binsPerChannel ** 3
+        self._binsPerChannel = binsPerChannel
+        self._cellSize = cellSize
+        self._imageSize = (w, h)
+
+        # Count the pixels in each bin of each cell, one row of cells at
+        # a time, so that the per-pixel arrays are only a strip of the
+        # image, in the smallest types that hold the bins and keys.
+        # Accumulate each row into the table, which holds the counts of
+        # the cells above and to the left of each corner.
+        shift = 8 - int(numpy.log2(binsPerChannel))
+        binType = numpy.uint16 if numBins <= 2 ** 16 else numpy.uint32
+        keyType = numpy.int32 if numCols * numBins < 2 ** 31 \
+                else numpy.int64
+        cellKeys = (numpy.arange(w) // cellSize).astype(keyType) * numBins
+        self._table = numpy.zeros((numRows + 1, numCols + 1, numBins),
+                                  numpy.int32)
+        for row in range(numRows):
+            strip = image[row * cellSize:(row + 1) * cellSize]
+            bins = (strip[:, :, 0] >> shift).astype(binType)
+            bins *= binsPerChannel
+            bins += strip[:, :, 1] >> shift
+            bins *= binsPerChannel
+            bins += strip[:, :, 2] >> shift
+            counts = numpy.bincount(
+                    (cellKeys + bins).ravel(),
+                    minlength=numCols * numBins).reshape(numCols, numBins)
+            tableRow = self._table[row + 1, 1:]
+            numpy.cumsum(counts, axis=0, out=tableRow)
+            tableRow += self._table[row, 1:]
+
+    @property
+    def binsPerChannel(self):
+        return self._binsPerChannel
+
+    @property
+    def cellSize(self):
+        return self._cellSize
+
+    @property
+    def numCellRows(self):
+        return self._table.shape[0] - 1
+
+    @property
+    def numCellCols(self):
+        return self._table.shape[1] - 1
+
+    def regionHists(self, cellRects):
+        # Return the dense histograms of rectangles of cells, given as
+        # rows of (top, left, bottom, right), exclusive of the bottom
+        # and right.
+        top, left, bottom, right = numpy.asarray(cellRects).T
+        table = self._table
+        return table[bottom, right] - table[top, right] - \
+                table[bottom, left] + table[top, left]
+
+    def pixelRect(self, cellRect):
+        # Return the (x, y, w, h) of a rectangle of cells in pixels,
+        # clipped to the image.
+        top, left, bottom, right = cellRect
+        imageW, imageH = self._imageSize
+        x = left * self._cellSize
+        y = top * self._cellSize
+        return (x, y, min(right * self._cellSize, imageW) - x,
+                min(bottom * self._cellSize, imageH) - y)
+
+# The classifier of a batch worker process.
+_batchWorkerClassifier = None
+
+def _initBatchWorker(binsPerChannel, modelPath, references, settings):
+    global _batchWorkerClassifier
+    classifier = HistogramClassifier(binsPerChannel)
+    for name, value in settings.items():
+        setattr(classifier, name, value)
+    if modelPath is not None:
+        # Load the model from the file, which may be mapped and shared
+        # with other processes.
+        classifier.deserialize(modelPath)
+    else:
+        for label, referenceHists in references.items():
+            for referenceHist in referenceHists:
+                classifier.addReferenceHist(referenceHist, label)
+    _batchWorkerClassifier = classifier
+
+def _classifyImageInBatchWorker(image):
+    return _batchWorkerClassifier.classifyWithSimilarities(image)
+
+def _classifyFileInBatchWorker(path):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        sys.stderr.write('Failed to decode image from %s\n' % path)
+        return 'Unknown', {}
+    return _batchWorkerClassifier.classifyWithSimilarities(image, path)
+
+def _classifyImageDataInBatchWorker(imageDataAndFlags):
+    imageData, imreadFlags = imageDataAndFlags
+    image = cv2.imdecode(numpy.frombuffer(imageData, numpy.uint8),
+                         imreadFlags)
+    if image is None:
+        return None
+    return _batchWorkerClassifier.classifyWithSimilarities(image)
 
 class HistogramClassifier(object):
 
-    def __init__(self):
+    def __init__(self, binsPerChannel=256):
+
+        if binsPerChannel < 1 or 256 % binsPerChannel != 0:
+            raise ValueError(
+                    'binsPerChannel must be a power of 2 from 1 to 256, '
+                    'not %r' % binsPerChannel)
 
         self.verbose = False
         self.minimumSimilarityForPositiveLabel = 0.075
 
+        # Whether to score queries via an inverted index of bins.
+        # The index pays off when there are many references. It scores
+        # every label, so it cannot be combined with usePruning or
+        # useTwoStage.
+        self.useBinIndex = False
+
+        # Whether to stop scoring a label's references once the label
+        # can no longer be the best. The result is the same, but the
+        # similarities of pruned labels are not reported.
+        self.usePruning = False
+
+        # Whether to score queries against coarse histograms first, and
+        # then re-score only the most similar labels against the full
+        # histograms. A label's coarse similarity is an upper bound of
+        # its full similarity, so with no limit on the number of labels
+        # and no margin, the result is the same as exhaustive scoring.
+        self.useTwoStage = False
+        self.twoStageBinsPerChannel = 8
+        # The maximum number of labels to re-score, or None.
+        self.twoStageTopLabels = None
+        # The maximum shortfall of a label's coarse similarity, relative
+        # to the best coarse similarity, for re-scoring, or None.
+        self.twoStageMargin = None
+        # Whether to also score queries exhaustively and count the
+        # disagreements, to measure the effect of the above limits.
+        self.verifyTwoStage = False
+
+        # The maximum number of pixels to sample for a histogram, or
+        # None to sample every pixel. Larger images are sampled either
+        # with a stride ('stride'), which preserves the exact colors,
+        # or via an area-averaged copy ('area').
+        self.maxHistPixels = None
+        self.histSampling = 'stride'
+
+        self._binIndex = None
+        self._coarseRows = None
+        self._coarseRowsBinsPerChannel = None
+        self._coarseStage = None
+        self.resetPruningStats()
+        self.resetTwoStageStats()
+        self._generation = 0
+
+        # Count the changes to the references, so that batch workers
+        # can be restarted with the latest references.
+        self._modelVersion = 0
+        self._loadedModelPath = None
+        self._loadedModelVersion = None
+        self._batchPool = None
+        self._batchPoolKey = None
+
         self._channels = range(3)
-        self._histSize = [256] * 3
-        self._ranges = [0, 255] * 3
+        self._setBinsPerChannel(binsPerChannel)
         self._references = {}
 
-    def _createNormalizedHist(self, image, sparse):
+    @property
+    def binsPerChannel(self):
+        return self._binsPerChannel
+
+    @property
+    def twoStageTopLabels(self):
+        return self._twoStageTopLabels
+
+    @twoStageTopLabels.setter
+    def twoStageTopLabels(self, twoStageTopLabels):
+        if twoStageTopLabels is not None and twoStageTopLabels < 1:
+            raise ValueError(
+                    'twoStageTopLabels must be None or at least 1, not %r' %
+                    twoStageTopLabels)
+        self._twoStageTopLabels = twoStageTopLabels
+
+    def _setBinsPerChannel(self, binsPerChannel):
+        self._binsPerChannel = binsPerChannel
+        self._numBins = binsPerChannel ** 3
+        self._histSize = [binsPerChannel] * 3
+        # Divide the full range of 8-bit values evenly, so that each
+        # coarse bin covers whole fine bins and rebinned models match
+        # queries at their new size. Models that were trained before
+        # binsPerChannel was configurable used ranges of [0, 255], which
+        # omit every pixel with a channel of 255. They still load, but
+        # they should be rebuilt with BuildClassifier.py so that they
+        # count saturated pixels as queries do.
+        self._ranges = [0, 256] * 3
+
+    def createHist(self, image):
+        image = self._sampleForHist(image)
+        if image.dtype == numpy.uint8 and image.ndim == 3 and \
+                image.shape[2] == 3 and \
+                image.shape[0] * image.shape[1] * 16 < self._numBins:
+            # There are far fewer pixels than bins, so avoid filling and
+            # scanning a dense histogram.
+            return self._createHistFromPixels(image)
         # Create the histogram.
         hist = cv2.calcHist([image], self._channels, None,
                             self._histSize, self._ranges)
-        # Normalize the histogram.
-        hist[:] = hist * (1.0 / numpy.sum(hist))
-        # Convert the histogram to one column for efficient storage.
-        hist = hist.reshape(16777216, 1)  # 16777216 == pow(2, 24)
-        if sparse:
-            # Convert the histogram to a sparse matrix.
-            hist = scipy.sparse.csc_matrix(hist)
-        return hist
+        # Keep only the occupied bins, with their raw counts.
+        hist = hist.ravel()
+        indices = numpy.flatnonzero(hist)
+        return CompactHist.fromCounts(indices, hist[indices])
+
+    def _createHistFromPixels(self, image):
+        # Compute each pixel's bin, in the same layout as calcHist, and
+        # count the distinct bins.
+        pixels = image.reshape(-1, 3)
+        shift = 8 - int(numpy.log2(self._binsPerChannel))
+        channels = pixels.astype(numpy.uint32) >> shift
+        bins = (channels[:, 0] * self._binsPerChannel +
+                channels[:, 1]) * self._binsPerChannel + channels[:, 2]
+        indices, counts = numpy.unique(bins, return_counts=True)
+        return CompactHist.fromCounts(indices, counts)
+
+    def _sampleForHist(self, image):
+        if self.maxHistPixels is None:
+            return image
+        h, w = image.shape[:2]
+        if w * h <= self.maxHistPixels:
+            return image
+        if self.histSampling == 'area':
+            scale = (self.maxHistPixels / float(w * h)) ** 0.5
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if self.histSampling == 'stride':
+            stride = int(numpy.ceil(
+                    (w * h / float(self.maxHistPixels)) ** 0.5))
+            return numpy.ascontiguousarray(image[::stride, ::stride])
+        raise ValueError(
+                'Unknown histogram sampling: %r' % self.histSampling)
 
     def addReference(self, image, label):
-        hist = self._createNormalizedHist(image, True)
+        self.addReferenceHist(self.createHist(image), label)
+
+    def addReferenceHist(self, hist, label):
+        hist = hist.packed()
+        self._modelVersion += 1
         if label not in self._references:
             self._references[label] = [hist]
         else:
             self._references[label] += [hist]
+        if self._binIndex is not None:
+            self._binIndex.add(hist, label)
+        if self._coarseRows is not None:
+            self._coarseRows.setdefault(label, []).append(
+                    self._createCoarseRow(hist))
+            self._coarseStage = None
 
     def addReferenceFromFile(self, path, label):
         image = cv2.imread(path, cv2.IMREAD_COLOR)
         self.addReference(image, label)
 
+    def memoryUsageByLabel(self):
+        # Return the bytes used by each label's reference histograms.
+        return dict((label, sum(hist.nbytes for hist in referenceHists))
+                    for label, referenceHists in self._references.items())
+
+    def rebin(self, binsPerChannel):
+        if binsPerChannel > self._binsPerChannel or \
+                self._binsPerChannel % binsPerChannel != 0:
+            raise ValueError(
+                    'Cannot rebin %d bins per channel to %r' % \
+                    (self._binsPerChannel, binsPerChannel))
+        for label, referenceHists in self._references.items():
+            self._references[label] = [
+                    self._rebinHist(referenceHist, binsPerChannel).packed()
+                    for referenceHist in referenceHists]
+        self._setBinsPerChannel(binsPerChannel)
+        self._modelVersion += 1
+        self._resetDerivedData()
+
+    def condense(self, maxReferencesPerLabel=None, maxAccuracyLoss=None,
+                 seed=0):
+        # Keep a representative subset of each label's references,
+        # chosen by k-medoids under the distance 1 - similarity. Every
+        # label keeps the same number of references, or all of them if
+        # it has fewer. The number is at most maxReferencesPerLabel.
+        # If maxAccuracyLoss is set, the number is the smallest one
+        # whose leave-one-out accuracy on the existing references is no
+        # more than maxAccuracyLoss below that of all the references.
+        # The similarities between all pairs of references are held in
+        # memory, which takes 4 * N^2 bytes for N references.
+        # Return a dict that describes the result.
+        if maxReferencesPerLabel is None and maxAccuracyLoss is None:
+            raise ValueError(
+                    'Specify maxReferencesPerLabel, maxAccuracyLoss or '
+                    'both')
+        labels = list(self._references)
+        hists = []
+        labelIDs = []
+        for labelID, label in enumerate(labels):
+            hists += self._references[label]
+            labelIDs += [labelID] * len(self._references[label])
+        labelIDs = numpy.array(labelIDs)
+        numReferences = len(hists)
+        if numReferences == 0:
+            raise ValueError('There are no references to condense')
+
+        # Score every reference against every other.
+        binIndex = _BinIndex(self._numBins)
+        for hist, labelID in zip(hists, labelIDs):
+            binIndex.add(hist, labelID)
+        similarities = numpy.empty((numReferences, numReferences),
+                                   numpy.float32)
+        for i, hist in enumerate(hists):
+            similarities[i] = binIndex.referenceSimilarities(hist)
+        binIndex = None
+
+        positionsByLabel = [numpy.flatnonzero(labelIDs == labelID)
+                            for labelID in range(len(labels))]
+        selections = {}
+        def select(numMedoids):
+            if numMedoids not in selections:
+                random = numpy.random.RandomState(seed)
+                selected = numpy.zeros(numReferences, bool)
+                for positions in positionsByLabel:
+                    block = similarities[numpy.ix_(positions, positions)]
+                    distances = 1.0 - 0.5 * (block.astype(numpy.float64) +
+                                             block.T)
+                    selected[positions[_chooseKMedoids(
+                            distances, numMedoids, random)]] = True
+                selections[numMedoids] = selected
+            return selections[numMedoids]
+        def computeAccuracy(selected):
+            return self._computeLeaveOneOutAccuracy(
+                    similarities, labelIDs, len(labels), selected)
+
+        accuracyBefore = computeAccuracy(numpy.ones(numReferences, bool))
+        largestLabelSize = max(len(positions)
+                               for positions in positionsByLabel)
+        numMedoids = largestLabelSize
+        if maxReferencesPerLabel is not None:
+            numMedoids = max(1, min(maxReferencesPerLabel, numMedoids))
+        if maxAccuracyLoss is not None:
+            minAccuracy = accuracyBefore - maxAccuracyLoss
+            def isAcceptable(numMedoids):
+                return computeAccuracy(select(numMedoids)) >= minAccuracy
+            # Double the number until it is acceptable, and then bisect
+            # between the last unacceptable number and it.
+            unacceptable = 0
+            acceptable = 1
+            while acceptable < numMedoids and \
+                    not isAcceptable(acceptable):
+                unacceptable = acceptable
+                acceptable = min(2 * acceptable, numMedoids)
+            while acceptable - unacceptable > 1:
+                middle = (unacceptable + acceptable) // 2
+                if isAcceptable(middle):
+                    acceptable = middle
+                else:
+                    unacceptable = middle
+            numMedoids = acceptable
+
+        selected = select(numMedoids)
+        accuracyAfter = computeAccuracy(selected)
+        self._references = dict(
+                (label, [hists[position]
+                         for position in positionsByLabel[labelID]
+                         if selected[position]])
+                for labelID, label in enumerate(labels))
+        self._modelVersion += 1
+        self._resetDerivedData()
+        return {
+            'referencesPerLabel': numMedoids,
+            'referencesBefore': numReferences,
+            'referencesAfter': int(selected.sum()),
+            'accuracyBefore': accuracyBefore,
+            'accuracyAfter': accuracyAfter
+        }
+
+    def _computeLeaveOneOutAccuracy(self, similarities, labelIDs,
+                                    numLabels, selected):
+        # Classify each reference by its mean similarity to the selected
+        # references of each label, excluding itself, and return the
+        # fraction that get their own label. A label with no other
+        # selected references has a similarity of 0.
+        numReferences = len(labelIDs)
+        selectedPositions = numpy.flatnonzero(selected)
+        selectedLabelIDs = labelIDs[selectedPositions]
+        memberships = numpy.zeros((numReferences, numLabels),
+                                  numpy.float32)
+        memberships[selectedPositions, selectedLabelIDs] = 1.0
+        sums = numpy.dot(similarities, memberships).astype(numpy.float64)
+        counts = numpy.tile(memberships.sum(axis=0), (numReferences, 1))
+        sums[selectedPositions, selectedLabelIDs] -= similarities[
+                selectedPositions, selectedPositions]
+        counts[selectedPositions, selectedLabelIDs] -= 1.0
+        means = sums / numpy.maximum(counts, 1.0)
+        bestLabelIDs = numpy.argmax(means, axis=1)
+        correct = (bestLabelIDs == labelIDs) & \
+                (means[numpy.arange(numReferences), bestLabelIDs] >
+                 self.minimumSimilarityForPositiveLabel)
+        return float(correct.mean())
+
+    def _resetDerivedData(self):
+        self._coarseRows = None
+        self._coarseStage = None
+        self._binIndex = None
+        if self.useBinIndex:
+            self._getBinIndex()
+
+    def _getBinIndex(self):
+        binIndex = self._binIndex
+        if binIndex is None:
+            # Publish the index only once it is complete, since other
+            # threads may be classifying.
+            binIndex = _BinIndex(self._numBins)
+            for label, referenceHists in self._references.items():
+                for referenceHist in referenceHists:
+                    binIndex.add(referenceHist, label)
+            self._binIndex = binIndex
+        return binIndex
+
+    def _rebinHist(self, hist, binsPerChannel):
+        # Map each occupied bin to the coarse bin that contains it.
+        # Histograms are laid out in C order, with channel 0 varying
+        # slowest.
+        fineShape = (self._binsPerChannel,) * 3
+        coarseShape = (binsPerChannel,) * 3
+        scale = self._binsPerChannel // binsPerChannel
+        coords = numpy.unravel_index(hist.indices, fineShape)
+        coarseIndices = numpy.ravel_multi_index(
+                [c // scale for c in coords], coarseShape)
+        # Sum the counts of fine bins that share a coarse bin.
+        coarseIndices, inverse = numpy.unique(
+                coarseIndices, return_inverse=True)
+        coarseCounts = numpy.bincount(inverse, hist.counts)
+        return CompactHist.fromCounts(
+                coarseIndices, coarseCounts, hist.total)
+
+    @property
+    def pruningStats(self):
+        return dict(self._pruningStats)
+
+    def resetPruningStats(self):
+        self._pruningStats = {
+            'referencesScored': 0,
+            'referencesSkipped': 0,
+            'labelsPruned': 0
+        }
+
+    @property
+    def twoStageStats(self):
+        return dict(self._twoStageStats)
+
+    def resetTwoStageStats(self):
+        self._twoStageStats = {
+            'queries': 0,
+            'labelsRescored': 0,
+            'labelsSkipped': 0,
+            'verifiedQueries': 0,
+            'disagreements': 0
+        }
+
     def classify(self, queryImage, queryImageName=None):
-        queryHist = self._createNormalizedHist(queryImage, False)
-        bestLabel = 'Unknown'
-        bestSimilarity = self.minimumSimilarityForPositiveLabel
+        return self.classifyWithSimilarities(
+                queryImage, queryImageName)[0]
+
+    def classifyWithSimilarities(self, queryImage, queryImageName=None):
+        # Return the best label and a dict of mean similarity by label.
+        # Labels that were skipped because they could not be the best
+        # are omitted.
+        queryHist = self.createHist(queryImage)
         if self.verbose:
             print('================================================')
             if queryImageName is not None:
                 print('Query image:')
                 print('    %s' % queryImageName)
             print('Mean similarity to reference images by label:')
-        for label, referenceHists in self._references.items():
-            similarity = 0.0
-            for referenceHist in referenceHists:
-                similarity += cv2.compareHist(
-                        referenceHist.todense(), queryHist,
-                        cv2.HISTCMP_INTERSECT)
-            similarity /= len(referenceHists)
-            if self.verbose:
-                print('    %8f  %s' % (similarity, label))
-            if similarity > bestSimilarity:
-                bestLabel = label
-                bestSimilarity = similarity
+        similarities = self._computeSimilarities(queryHist)
+        if self.verbose:
+            for label, similarity in similarities:
+                if similarity is None:
+                    print('    %8s  %s' % ('skipped', label))
+                else:
+                    print('    %8f  %s' % (similarity, label))
+        bestLabel = self._chooseLabel(similarities)
+        if self.verifyTwoStage and self._canUseTwoStage():
+            exhaustiveLabel = self._chooseLabel(
+                    self._computeExhaustiveSimilarities(queryHist))
+            self._twoStageStats['verifiedQueries'] += 1
+            if exhaustiveLabel != bestLabel:
+                self._twoStageStats['disagreements'] += 1
+                if self.verbose:
+                    print('Exhaustive scoring chose %s instead' % \
+                          exhaustiveLabel)
         if self.verbose:
             print('================================================')
+        return bestLabel, dict(
+                (label, similarity) for label, similarity in similarities
+                if similarity is not None)
+
+    def _chooseLabel(self, similarities):
+        bestLabel = 'Unknown'
+        bestSimilarity = self.minimumSimilarityForPositiveLabel
+        for label, similarity in similarities:
+            if similarity is not None and similarity > bestSimilarity:
+                bestLabel = label
+                bestSimilarity = similarity
         return bestLabel
 
+    def _computeSimilarities(self, queryHist):
+        # Return (label, mean similarity) pairs in the order of the
+        # references. The similarity is None for labels that were
+        # skipped because they could not be the best.
+        if self.useBinIndex:
+            if self.usePruning or self.useTwoStage:
+                raise ValueError(
+                        'useBinIndex cannot be combined with usePruning or '
+                        'useTwoStage')
+            similarities = self._getBinIndex().similarities(queryHist)
+            return [(label, similarities[label])
+                    for label in self._references]
+        if self._canUseTwoStage():
+            similarities = self._computeTwoStageSimilarities(queryHist)
+            return [(label, similarities.get(label))
+                    for label in self._references]
+        if not self.usePruning:
+            return self._computeExhaustiveSimilarities(queryHist)
+        similarities = []
+        bestSimilarity = self.minimumSimilarityForPositiveLabel
+        for label, referenceHists in self._references.items():
+            similarity = self._computeMeanSimilarityWithPruning(
+                    queryHist, referenceHists, bestSimilarity)
+            if similarity is not None:
+                bestSimilarity = max(bestSimilarity, similarity)
+            similarities.append((label, similarity))
+        return similarities
+
+    def _computeExhaustiveSimilarities(self, queryHist):
+        return [(label, self._computeMeanSimilarity(queryHist,
+                                                    referenceHists))
+                for label, referenceHists in self._references.items()]
+
+    def _computeMeanSimilarity(self, queryHist, referenceHists):
+        similarity = 0.0
+        for referenceHist in referenceHists:
+            similarity += intersectSparseHists(referenceHist, queryHist)
+        return similarity / len(referenceHists)
+
+    def _computeMeanSimilarityWithPruning(self, queryHist, referenceHists,
+                                          bestSimilarity,
+                                          upperBounds=None):
+        # The label's mean similarity is at most the sum of the scores
+        # so far, plus an upper bound per remaining reference, over the
+        # number of references. Once that cannot beat the best
+        # similarity, return None.
+        # The intersection of normalized histograms is at most 1, so
+        # that is the default upper bound.
+        numReferences = len(referenceHists)
+        if upperBounds is None:
+            remainingBounds = numpy.arange(numReferences, 0, -1)
+        else:
+            remainingBounds = numpy.cumsum(upperBounds[::-1])[::-1]
+        similarity = 0.0
+        for i, referenceHist in enumerate(referenceHists):
+            upperBound = (similarity + remainingBounds[i]) / numReferences
+            if upperBound <= bestSimilarity:
+                self._pruningStats['referencesSkipped'] += \
+                        numReferences - i
+                self._pruningStats['labelsPruned'] += 1
+                return None
+            similarity += intersectSparseHists(referenceHist, queryHist)
+            self._pruningStats['referencesScored'] += 1
+        return similarity / numReferences
+
+    def _canUseTwoStage(self):
+        return self.useTwoStage and \
+                self.twoStageBinsPerChannel < self._binsPerChannel and \
+                self._binsPerChannel % self.twoStageBinsPerChannel == 0
+
+    def _createCoarseRow(self, hist):
+        # Create a dense, normalized coarse histogram.
+        coarseHist = self._rebinHist(hist, self.twoStageBinsPerChannel)
+        row = numpy.zeros(self.twoStageBinsPerChannel ** 3, numpy.float32)
+        row[coarseHist.indices] = coarseHist.counts / \
+                float(coarseHist.total)
+        return row
+
+    def _getCoarseStage(self):
+        # Build into locals and publish each result only once it is
+        # complete, since other threads may be classifying.
+        binsPerChannel = self.twoStageBinsPerChannel
+        coarseRows = self._coarseRows
+        coarseStage = self._coarseStage
+        if self._coarseRowsBinsPerChannel != binsPerChannel:
+            coarseRows = None
+            coarseStage = None
+        if coarseRows is None:
+            coarseRows = {}
+            for label, referenceHists in self._references.items():
+                coarseRows[label] = [
+                        self._createCoarseRow(referenceHist)
+                        for referenceHist in referenceHists]
+            self._coarseRowsBinsPerChannel = binsPerChannel
+            self._coarseRows = coarseRows
+        if coarseStage is None:
+            # Stack every reference's coarse histogram in one matrix,
+            # grouped by label in the order of the references.
+            labels = list(self._references.keys())
+            rows = []
+            labelStarts = [0]
+            for label in labels:
+                rows += coarseRows[label]
+                labelStarts.append(len(rows))
+            if rows:
+                matrix = numpy.vstack(rows)
+            else:
+                matrix = numpy.zeros(
+                        (0, binsPerChannel ** 3), numpy.float32)
+            coarseStage = labels, matrix, labelStarts
+            self._coarseStage = coarseStage
+        return coarseStage
+
+    def _computeTwoStageSimilarities(self, queryHist):
+        # Return a dict of mean similarity by label, for the labels that
+        # were re-scored.
+        labels, matrix, labelStarts = self._getCoarseStage()
+        if not labels:
+            return {}
+        self._twoStageStats['queries'] += 1
+        # Score every reference's coarse histogram in one pass.
+        # Coarse intersections are upper bounds of full ones. Allow for
+        # rounding in the coarse histograms.
+        queryRow = self._createCoarseRow(queryHist)
+        coarseScores = numpy.minimum(matrix, queryRow).sum(
+                axis=1, dtype=numpy.float64) + 1e-6
+        counts = numpy.diff(labelStarts)
+        coarseMeans = numpy.add.reduceat(coarseScores, labelStarts[:-1]) / \
+                counts
+        order = numpy.argsort(-coarseMeans, kind='mergesort')
+        if self.twoStageTopLabels is not None:
+            order = order[:self.twoStageTopLabels]
+        if self.twoStageMargin is not None and len(order) > 0:
+            order = order[coarseMeans[order] >=
+                          coarseMeans[order[0]] - self.twoStageMargin]
+        # Re-score labels in order of coarse similarity until no other
+        # label can beat the best.
+        similarities = {}
+        bestSimilarity = self.minimumSimilarityForPositiveLabel
+        numRescoredLabels = 0
+        for labelID in order:
+            if coarseMeans[labelID] <= bestSimilarity:
+                break
+            label = labels[labelID]
+            similarity = self._computeMeanSimilarityWithPruning(
+                    queryHist, self._references[label], bestSimilarity,
+                    coarseScores[labelStarts[labelID]:
+                                 labelStarts[labelID + 1]])
+            numRescoredLabels += 1
+            if similarity is not None:
+                similarities[label] = similarity
+                bestSimilarity = max(bestSimilarity, similarity)
+        self._twoStageStats['labelsRescored'] += numRescoredLabels
+        self._twoStageStats['labelsSkipped'] += \
+                len(labels) - numRescoredLabels
+        return similarities
+
+    def createIntegralHist(self, image, cellSize=16):
+        # Create an integral histogram in the coarse layout of
+        # twoStageBinsPerChannel.
+        if self.twoStageBinsPerChannel > self._binsPerChannel or \
+                self._binsPerChannel % self.twoStageBinsPerChannel != 0:
+            raise ValueError(
+                    'Cannot classify regions with %r bins per channel '
+                    'when references have %d' % \
+                    (self.twoStageBinsPerChannel, self._binsPerChannel))
+        return IntegralHist(image, self.twoStageBinsPerChannel, cellSize)
+
+    def classifyRegions(self, queryImage, gridShape=(3, 3),
+                        windowCells=None, strideCells=None, cellSize=None,
+                        integralHist=None):
+        # Classify regions of an image, either a grid of gridShape
+        # (rows, columns), or if windowCells is set, a sliding window
+        # of (rows, columns) cells that moves by strideCells, which
+        # defaults to windowCells. Regions are scored by mean similarity
+        # to each label's references in the coarse layout of
+        # twoStageBinsPerChannel. Coarse similarities are higher than
+        # full ones, so minimumSimilarityForPositiveLabel is more easily
+        # met.
+        # Return a label map, a dict of similarity maps by label, and
+        # the (x, y, w, h) of each region in pixels, where each map is
+        # indexed by the region's row and column.
+        # By default, a grid's cells are sized so that each region spans
+        # about GRID_CELLS_PER_REGION cells, whatever the image size,
+        # which keeps the integral histogram small for large images.
+        if integralHist is None:
+            if cellSize is None:
+                if windowCells is None:
+                    h, w = queryImage.shape[:2]
+                    cellSize = max(1, min(
+                            h // (gridShape[0] * GRID_CELLS_PER_REGION),
+                            w // (gridShape[1] * GRID_CELLS_PER_REGION)))
+                else:
+                    cellSize = WINDOW_CELL_SIZE
+            integralHist = self.createIntegralHist(queryImage, cellSize)
+        numCellRows = integralHist.numCellRows
+        numCellCols = integralHist.numCellCols
+        if windowCells is None:
+            numRows, numCols = gridShape
+            if numRows > numCellRows or numCols > numCellCols:
+                raise ValueError(
+                        'A grid of %dx%d regions needs a smaller cell '
+                        'size than %d' % (numRows, numCols,
+                                          integralHist.cellSize))
+            rowEdges = numpy.linspace(0, numCellRows,
+                                      numRows + 1).astype(int)
+            colEdges = numpy.linspace(0, numCellCols,
+                                      numCols + 1).astype(int)
+            tops, bottoms = rowEdges[:-1], rowEdges[1:]
+            lefts, rights = colEdges[:-1], colEdges[1:]
+        else:
+            windowRows, windowCols = windowCells
+            if strideCells is None:
+                strideCells = windowCells
+            strideRows, strideCols = strideCells
+            tops = numpy.arange(0, max(1, numCellRows - windowRows + 1),
+                                strideRows)
+            lefts = numpy.arange(0, max(1, numCellCols - windowCols + 1),
+                                 strideCols)
+            bottoms = numpy.minimum(tops + windowRows, numCellRows)
+            rights = numpy.minimum(lefts + windowCols, numCellCols)
+            numRows, numCols = len(tops), len(lefts)
+        cellRects = numpy.array(
+                [(top, left, bottom, right)
+                 for top, bottom in zip(tops, bottoms)
+                 for left, right in zip(lefts, rights)])
+
+        labels, matrix, labelStarts = self._getCoarseStage()
+        regionHists = integralHist.regionHists(cellRects).astype(
+                numpy.float32)
+        regionHists /= numpy.maximum(
+                regionHists.sum(axis=1, keepdims=True), 1.0)
+        similarities = numpy.zeros((len(cellRects), len(labels)))
+        if labels:
+            # Score a chunk of regions against every reference at once,
+            # limiting the size of the intermediate array.
+            chunkSize = max(1, 2 ** 24 // matrix.size)
+            counts = numpy.diff(labelStarts)
+            for start in range(0, len(cellRects), chunkSize):
+                chunk = regionHists[start:start + chunkSize]
+                scores = numpy.minimum(
+                        matrix[numpy.newaxis], chunk[:, numpy.newaxis]).sum(
+                                axis=2, dtype=numpy.float64)
+                similarities[start:start + chunkSize] = \
+                        numpy.add.reduceat(scores, labelStarts[:-1],
+                                           axis=1) / counts
+
+        labelMap = numpy.empty(len(cellRects), object)
+        labelMap[:] = 'Unknown'
+        if labels:
+            bestLabelIDs = numpy.argmax(similarities, axis=1)
+            positive = similarities[numpy.arange(len(cellRects)),
+                                    bestLabelIDs] > \
+                    self.minimumSimilarityForPositiveLabel
+            labelMap[positive] = [labels[labelID] for labelID in
+                                  bestLabelIDs[positive]]
+        similarityMaps = dict(
+                (label, similarities[:, labelID].reshape(numRows, numCols))
+                for labelID, label in enumerate(labels))
+        rects = numpy.array([integralHist.pixelRect(cellRect)
+                             for cellRect in cellRects]).reshape(
+                                     numRows, numCols, 4)
+        if self.verbose:
+            print('Labels of %dx%d regions:' % (numRows, numCols))
+            for row in labelMap.reshape(numRows, numCols):
+                print('    %s' % ' | '.join(row))
+        return labelMap.reshape(numRows, numCols), similarityMaps, rects
+
     def classifyFromFile(self, path, queryImageName=None):
         if queryImageName is None:
             queryImageName = path
         queryImage = cv2.imread(path, cv2.IMREAD_COLOR)
         return self.classify(queryImage, queryImageName)
 
+    def classifyBatch(self, images, processes=None):
+        # Classify images in a pool of processes, which defaults to one
+        # process per CPU. Return a list of (label, similarities by
+        # label) pairs in the order of the images.
+        return self._getBatchPool(processes).map(
+                _classifyImageInBatchWorker, images)
+
+    def classifyFilesBatch(self, paths, processes=None):
+        # Like classifyBatch, but the workers also decode the images.
+        return self._getBatchPool(processes).map(
+                _classifyFileInBatchWorker, paths)
+
+    def classifyImageDataBatch(self, imageData, processes=None,
+                               imreadFlags=None):
+        # Like classifyBatch, but the images are encoded, such as
+        # downloaded JPEGs, and the workers decode them, with one set of
+        # cv2.imread flags per image or else cv2.IMREAD_COLOR. The
+        # encoded images are much cheaper to send to the workers. The
+        # result is None for each image that fails to decode. Several
+        # threads may call this at once, once the pool exists.
+        if imreadFlags is None:
+            imreadFlags = [cv2.IMREAD_COLOR] * len(imageData)
+        return self._getBatchPool(processes).map(
+                _classifyImageDataInBatchWorker,
+                list(zip(imageData, imreadFlags)))
+
+    def closeBatchPool(self):
+        if self._batchPool is not None:
+            self._batchPool.close()
+            self._batchPool.join()
+            self._batchPool = None
+            self._batchPoolKey = None
+
+    def _getSharedModelPath(self):
+        # Return the path of a model that matches the references, or
+        # None if the references have changed since they were loaded.
+        if self._loadedModelVersion == self._modelVersion:
+            return self._loadedModelPath
+        return None
+
+    def _getBatchPool(self, processes):
+        settings = {
+            'minimumSimilarityForPositiveLabel':
+                    self.minimumSimilarityForPositiveLabel,
+            'useBinIndex': self.useBinIndex,
+            'usePruning': self.usePruning,
+            'useTwoStage': self.useTwoStage,
+            'twoStageBinsPerChannel': self.twoStageBinsPerChannel,
+            'twoStageTopLabels': self.twoStageTopLabels,
+            'twoStageMargin': self.twoStageMargin,
+            'maxHistPixels': self.maxHistPixels,
+            'histSampling': self.histSampling
+        }
+        key = (processes, self._modelVersion, sorted(settings.items()))
+        if self._batchPoolKey != key:
+            self.closeBatchPool()
+        if self._batchPool is None:
+            # Each worker gets the model once, when it starts, rather
+            # than with each task. If the model is in a mapped file,
+            # the workers load it from there and share its pages.
+            modelPath = self._getSharedModelPath()
+            if modelPath is None:
+                references = self._references
+            else:
+                references = None
+            self._batchPool = multiprocessing.Pool(
+                    processes, _initBatchWorker,
+                    (self._binsPerChannel, modelPath, references,
+                     settings))
+            self._batchPoolKey = key
+        return self._batchPool
+
     def serialize(self, path, compressed=False):
+        # Models with the .mat extension are saved in the MAT format,
+        # optionally compressed. Other models are saved in the
+        # memory-mapped format, which loads much faster.
+        if os.path.splitext(path)[1].lower() != '.mat':
+            writeMappedModel(path, self._binsPerChannel,
+                             self._references, self._generation)
+            return
+        if BINS_PER_CHANNEL_KEY in self._references:
+            raise ValueError(
+                    'The label "%s" is reserved' % BINS_PER_CHANNEL_KEY)
+        # Store each reference as a sparse column of raw counts.
+        model = {}
+        for label, referenceHists in self._references.items():
+            model[label] = [
+                    referenceHist.toSparseColumn(self._numBins)
+                    for referenceHist in referenceHists]
+        model[BINS_PER_CHANNEL_KEY] = numpy.array(
+                [self._binsPerChannel])
+        import scipy.io
         file = open(path, 'wb')
         scipy.io.savemat(
-            file, self._references, do_compression=compressed)
+            file, model, do_compression=compressed)
 
     def deserialize(self, path):
-        file = open(path, 'rb')
-        self._references = scipy.io.loadmat(file)
-        for key in list(self._references.keys()):
-            value = self._references[key]
-            if not isinstance(value, numpy.ndarray):
-                # This entry is serialization metadata so delete it.
-                del self._references[key]
-                continue
-            # The serializer wraps the data in an extra array.
-            # Unwrap the data.
-            self._references[key] = value[0]
+        binsPerChannel, references, generation = readModel(path)
+        if binsPerChannel != self._binsPerChannel:
+            raise ValueError(
+                    'The model at %s has %d bins per channel but the '
+                    'classifier expects %d. Create the classifier with '
+                    'binsPerChannel=%d or rebin the model.' % \
+                    (path, binsPerChannel, self._binsPerChannel,
+                     binsPerChannel))
+        self._references = references
+        self._generation = generation
+        self._modelVersion += 1
+        if isMappedModel(path):
+            self._loadedModelPath = os.path.abspath(path)
+            self._loadedModelVersion = self._modelVersion
+        self._resetDerivedData()
 
 def main():
     classifier = HistogramClassifier()
@@ -179,8 +1546,8 @@ def main():
             'images/panama_trump_exterior.jpg',
             'Luxury, exterior')
 
-    classifier.serialize('classifier.mat')
-    classifier.deserialize('classifier.mat')
+    classifier.serialize('classifier.hist')
+    classifier.deserialize('classifier.hist')
     classifier.classifyFromFile('images/dubai_damac_heights.jpg')
     classifier.classifyFromFile('images/communal_apartments_01.jpg')
 
@@ -1,24 +1,213 @@
 #!/usr/bin/env python
 
 
-from py_ms_cognitive import PyMsCognitiveImageSearch
-PyMsCognitiveImageSearch.SEARCH_IMAGE_BASE = \
-        'https://api.cognitive.microsoft.com/bing/v7.0/images/search'
-
+import collections
+import hashlib
+import json
 import numpy # Hint to PyInstaller
 import cv2
 import os
 import pprint
 import sys
+import threading
+import time
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
+import FileUtils
 import RequestsUtils
 
 
+SEARCH_IMAGE_BASE = \
+        'https://api.cognitive.microsoft.com/bing/v7.0/images/search'
+
+# The URL of the image search endpoint can be overridden, such as to use
+# a local stand-in for testing.
+SEARCH_URL_ENVIRONMENT_VARIABLE = 'BING_SEARCH_URL'
+
+# The maximum number of results to request at once, as py_ms_cognitive
+# allows.
+MAX_RESULTS_PER_REQUEST = 50
+
+# The default rate limit of searches, which is the quota of Bing's free
+# tier.
+SEARCHES_PER_SECOND = 3.0
+
+def _importImageResult():
+    # py_ms_cognitive imports requests, which is slow to import, so
+    # defer it until the first search.
+    from py_ms_cognitive.py_ms_cognitive_search.py_ms_cognitive_image_search \
+            import ImageResult
+    return ImageResult
+
+def _errorMessage(resultsJson):
+    # Return the message of an error response, in any of the formats
+    # that the API uses.
+    if isinstance(resultsJson, dict):
+        if 'errors' in resultsJson:
+            return '; '.join(error.get('message', '')
+                             for error in resultsJson['errors'])
+        if 'error' in resultsJson:
+            return resultsJson['error'].get('message', '')
+        if 'message' in resultsJson:
+            return resultsJson['message']
+    return str(resultsJson)
+
+class SearchResultCache(object):
+
+    # A cache of pages of search results, keyed by the query, offset,
+    # number of results and search parameters. Pages are kept in memory
+    # and, if a directory is given, on disk as JSON files, so that they
+    # survive restarts and can be shared by several processes. A page
+    # expires maxAge seconds after it was received.
+
+    def __init__(self, directory=None, maxAge=3600.0, maxPagesInMemory=64):
+        self.maxAge = maxAge
+        self.maxPagesInMemory = maxPagesInMemory
+
+        self._directory = directory
+        self._lock = threading.Lock()
+        # (time received, page) by key, in order of use.
+        self._pages = collections.OrderedDict()
+        self._stats = {
+            'memoryHits': 0,
+            'diskHits': 0,
+            'misses': 0,
+            'stores': 0
+        }
+        if directory is not None:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another process may have created it.
+                    if not os.path.isdir(directory):
+                        raise
+            self._removeExpired()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pagesInMemory'] = len(self._pages)
+        return stats
+
+    def _key(self, query, offset, count, params):
+        return json.dumps([query, offset, count, params or {}],
+                          sort_keys=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, name + '.json')
+
+    def get(self, query, offset, count, params=None):
+        # Return the page, or None if it is not cached or has expired.
+        key = self._key(query, offset, count, params)
+        now = time.time()
+        with self._lock:
+            entry = self._pages.pop(key, None)
+            if entry is not None and now - entry[0] < self.maxAge:
+                self._pages[key] = entry
+                self._stats['memoryHits'] += 1
+                return entry[1]
+        entry = self._read(key)
+        with self._lock:
+            if entry is None or now - entry[0] >= self.maxAge:
+                self._stats['misses'] += 1
+                return None
+            self._stats['diskHits'] += 1
+            self._storeInMemory(key, entry)
+        return entry[1]
+
+    def put(self, query, offset, count, params, page):
+        # Store a page, which must be serializable as JSON.
+        key = self._key(query, offset, count, params)
+        entry = (time.time(), page)
+        with self._lock:
+            self._stats['stores'] += 1
+            self._storeInMemory(key, entry)
+        if self._directory is None:
+            return
+        path = self._path(key)
+        tempPath = '%s.tmp%d.%d' % (path, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            with open(tempPath, 'w') as file:
+                json.dump({'key': key, 'received': entry[0],
+                           'page': page}, file)
+            FileUtils.replaceFile(tempPath, path)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to cache search results:\n')
+            sys.stderr.write('%s\n' % str(e))
+
+    def _storeInMemory(self, key, entry):
+        self._pages.pop(key, None)
+        self._pages[key] = entry
+        while len(self._pages) > self.maxPagesInMemory:
+            self._pages.popitem(last=False)
+
+    def _read(self, key):
+        if self._directory is None:
+            return None
+        try:
+            with open(self._path(key), 'r') as file:
+                stored = json.load(file)
+        except (IOError, OSError, ValueError):
+            return None
+        if stored.get('key') != key:
+            return None
+        return stored['received'], stored['page']
+
+    def _removeExpired(self):
+        # Remove expired pages, and temporary files that were abandoned
+        # by crashes.
+        now = time.time()
+        for fileName in os.listdir(self._directory):
+            path = os.path.join(self._directory, fileName)
+            try:
+                if now - os.path.getmtime(path) > \
+                        max(self.maxAge, 3600.0):
+                    os.remove(path)
+            except OSError:
+                continue
+
+
 class ImageSearchSession(object):
 
     def __init__(self):
         self.verbose = False
-        
+
+        # The image search endpoint, which should imitate Bing's v7 API.
+        self.searchUrl = os.environ.get(SEARCH_URL_ENVIRONMENT_VARIABLE,
+                                        SEARCH_IMAGE_BASE)
+        # The maximum rate of searches, shared by every session in the
+        # process, or None for no limit.
+        self.searchesPerSecond = SEARCHES_PER_SECOND
+
+        # The number of results on each side of a requested result to
+        # download and decode in the background, and if there is a
+        # prefetch classifier, to classify.
+        self.prefetchRadius = 0
+        self.prefetchClassifier = None
+        self.numPrefetchThreads = 2
+        # If set, JPEGs are decoded at a reduced resolution whose larger
+        # dimension is still at least this size.
+        self.targetImageSize = None
+        # The maximum number of results to keep decoded in memory.
+        # This should be at least 2 * prefetchRadius + 1.
+        self.maxCachedResults = 16
+        # Pages of results are reused from this cache, if it is not
+        # None, instead of being requested again.
+        self.searchResultCache = SearchResultCache()
+
         self._query = ''
         self._results = []
         self._offset = 0
@@ -26,6 +215,15 @@ class ImageSearchSession(object):
         self._numResultsReceived = 0
         self._numResultsAvailable = 0
 
+        # Decoded results by index, in order of use. Each search starts
+        # a new generation, and work for older generations is dropped.
+        self._cacheCondition = threading.Condition()
+        self._cache = collections.OrderedDict()
+        self._inFlightIndices = set()
+        self._generation = 0
+        self._prefetchQueue = queue.Queue()
+        self._prefetchThreads = []
+
     @property
     def query(self):
         return self._query
@@ -60,26 +258,83 @@ class ImageSearchSession(object):
         self.search(self._query, self._numResultsRequested, offset)
 
     def search(self, query, numResultsRequested=50, offset=0):
+        params = {'color':'ColorOnly', 'imageType':'Photo'}
+
+        cache = self.searchResultCache
+        # Results from different endpoints are cached separately.
+        cacheParams = dict(params, searchUrl=self.searchUrl)
+        page = None
+        if cache is not None:
+            page = cache.get(query, offset, numResultsRequested,
+                             cacheParams)
+        if page is None:
+            page = self._requestPage(query, numResultsRequested, offset,
+                                     params)
+            if page is None:
+                return
+            if cache is not None:
+                cache.put(query, offset, numResultsRequested, cacheParams,
+                          page)
+        elif self.verbose:
+            print('Reusing cached results of Bing image search for '
+                  '"%s":' % query)
+            pprint.pprint(page)
+
+        self._query = query
+        self._numResultsRequested = numResultsRequested
+        self._offset = offset
+
+        with self._cacheCondition:
+            # Cancel any prefetching of the previous results.
+            self._generation += 1
+            self._cache.clear()
+            self._inFlightIndices = set()
+            ImageResult = _importImageResult()
+            self._results = [ImageResult(value) for value in page['value']]
+            self._cacheCondition.notify_all()
+
+        self._numResultsReceived = len(self._results)
+        if self._numResultsRequested < self._numResultsReceived:
+            # The API returned more results than were requested.
+            self._numResultsRequested = self._numResultsReceived
+        self._numResultsAvailable = int(page['totalEstimatedMatches'])
+
+    def _requestPage(self, query, numResultsRequested, offset, params):
+        # Return the results and the estimated total number of results,
+        # as a dict that can be serialized as JSON, or None on failure.
         if 'BING_SEARCH_KEY' in os.environ:
             bingKey = os.environ['BING_SEARCH_KEY']
         else:
             sys.stderr.write(
                     'Environment variable BING_SEARCH_KEY is undefined. '
                     'Please define it, equal to your Bing Search API key.\n')
-            return
-
-        self._query = query
-        self._numResultsRequested = numResultsRequested
-        self._offset = offset
+            return None
 
-        params = {'color':'ColorOnly', 'imageType':'Photo'}
-
-        searchService = PyMsCognitiveImageSearch(
-                bingKey, query, custom_params=params)
-        searchService.current_offset = offset
+        # Request the page through RequestsUtils, rather than through
+        # py_ms_cognitive, so that searches reuse connections and obey
+        # the scheduler's rate limit and backoff.
+        scheduler = RequestsUtils.getScheduler()
+        if scheduler is not None:
+            scheduler.setRateLimit(self.searchUrl, self.searchesPerSecond)
+        payload = {
+            'q': query,
+            'count': min(numResultsRequested, MAX_RESULTS_PER_REQUEST),
+            'offset': offset
+        }
+        payload.update(params)
+        headers = {'Ocp-Apim-Subscription-Key': bingKey}
 
         try:
-            self._results = searchService.search(numResultsRequested, 'json')
+            response = RequestsUtils.get(self.searchUrl, params=payload,
+                                         headers=headers)
+            resultsJson = response.json()
+            if response.status_code != 200:
+                raise ValueError('Received status code %d: %s' % \
+                                 (response.status_code,
+                                  _errorMessage(resultsJson)))
+            values = resultsJson[u'value']
+            totalEstimatedMatches = \
+                    int(resultsJson[u'totalEstimatedMatches'])
         except Exception as e:
             sys.stderr.write(
                     'Error when requesting Bing image search for '
@@ -87,29 +342,129 @@ class ImageSearchSession(object):
             sys.stderr.write('%s\n' % str(e))
             self._offset = 0
             self._numResultsReceived = 0
-            return
-
-        json = searchService.most_recent_json
-        self._numResultsReceived = len(self._results)
-        if self._numResultsRequested < self._numResultsReceived:
-            # py_ms_cognitive modified the request to get more results.
-            self._numResultsRequested = self._numResultsReceived
-        self._numResultsAvailable = int(json[u'totalEstimatedMatches'])
+            return None
 
         if self.verbose:
             print('Received results of Bing image search for '
                   '"%s":' % query)
-            pprint.pprint(json)
+            pprint.pprint(resultsJson)
+        return {
+            'value': values,
+            'totalEstimatedMatches': totalEstimatedMatches
+        }
+
+    def getUrl(self, index, useThumbnail = False):
+        # Return the URL of a result, without downloading it.
+        if index >= self._numResultsReceived:
+            return None
+        if useThumbnail:
+            return self._results[index].thumbnail_url
+        return self._results[index].content_url
 
     def getCvImageAndUrl(self, index, useThumbnail = False):
+        image, url, label = self.getCvImageUrlAndLabel(index, useThumbnail)
+        return image, url
+
+    def getCvImageUrlAndLabel(self, index, useThumbnail = False):
+        # Return the image, its URL, and its label if it was classified
+        # by the prefetch classifier, or else None.
         if index >= self._numResultsReceived:
-            return None, None
-        result = self._results[index]
+            return None, None, None
         if useThumbnail:
-            url = result.thumbnail_url
-        else:
-            url = result.content_url
-        return RequestsUtils.cvImageFromUrl(url), url
+            url = self._results[index].thumbnail_url
+            return RequestsUtils.cvImageFromUrl(url), url, None
+        with self._cacheCondition:
+            generation = self._generation
+            # Wait for any prefetch of this result.
+            while index in self._inFlightIndices and \
+                    generation == self._generation:
+                self._cacheCondition.wait()
+            entry = None
+            if generation == self._generation:
+                entry = self._cache.get(index)
+                if entry is not None:
+                    self._cache.pop(index)
+                    self._cache[index] = entry
+            url = self._results[index].content_url
+        if entry is None:
+            entry = RequestsUtils.cvImageFromUrl(
+                    url, self.targetImageSize), url, None
+            self._storeInCache(generation, index, entry)
+        self._schedulePrefetch(index)
+        return entry
+
+    def isCached(self, index):
+        # Return whether the full image of a result is in memory, so
+        # that getCvImageUrlAndLabel will return it immediately.
+        with self._cacheCondition:
+            return index in self._cache
+
+    def _storeInCache(self, generation, index, entry):
+        with self._cacheCondition:
+            if generation != self._generation:
+                return
+            self._cache.pop(index, None)
+            self._cache[index] = entry
+            while len(self._cache) > self.maxCachedResults:
+                self._cache.popitem(last=False)
+
+    def _schedulePrefetch(self, index):
+        if self.prefetchRadius < 1:
+            return
+        with self._cacheCondition:
+            # Prefetch the nearest results first, favoring the next ones.
+            for distance in range(1, self.prefetchRadius + 1):
+                for neighbor in (index + distance, index - distance):
+                    if neighbor < 0 or \
+                            neighbor >= self._numResultsReceived or \
+                            neighbor in self._cache or \
+                            neighbor in self._inFlightIndices:
+                        continue
+                    self._inFlightIndices.add(neighbor)
+                    self._prefetchQueue.put((self._generation, neighbor))
+            # Replace any threads that have died.
+            self._prefetchThreads = [thread for thread in
+                                     self._prefetchThreads
+                                     if thread.is_alive()]
+            while len(self._prefetchThreads) < self.numPrefetchThreads:
+                thread = threading.Thread(target=self._prefetch)
+                thread.daemon = True
+                thread.start()
+                self._prefetchThreads.append(thread)
+
+    def _prefetch(self):
+        while True:
+            generation, index = self._prefetchQueue.get()
+            with self._cacheCondition:
+                if generation != self._generation:
+                    # The result is from a previous search.
+                    continue
+                url = self._results[index].content_url
+            image = None
+            label = None
+            try:
+                image = RequestsUtils.cvImageFromUrl(
+                        url, self.targetImageSize)
+                classifier = self.prefetchClassifier
+                if image is not None and classifier is not None:
+                    try:
+                        label = classifier.classify(image, url)
+                    except Exception as e:
+                        sys.stderr.write(
+                                'Error when classifying %s:\n' % url)
+                        sys.stderr.write('%s\n' % str(e))
+            except Exception as e:
+                sys.stderr.write('Error when prefetching %s:\n' % url)
+                sys.stderr.write('%s\n' % str(e))
+            finally:
+                # Always finish the result, so that no thread waits for
+                # it forever.
+                with self._cacheCondition:
+                    if generation == self._generation:
+                        self._inFlightIndices.discard(index)
+                        self._storeInCache(generation, index,
+                                           (image, url, label))
+                    self._cacheCondition.notify_all()
 
 def main():
     session = ImageSearchSession()
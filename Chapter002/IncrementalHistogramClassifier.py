@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+
+import numpy # Hint to PyInstaller
+import os
+import sys
+import threading
+
+import HistogramClassifier as HC
+
+
+class IncrementalHistogramClassifier(HC.HistogramClassifier):
+
+    # A classifier whose model lives at a path and can grow while it is
+    # in use. New references are appended to a segment file instead of
+    # rewriting the model. Compaction merges the segments into the
+    # model, either on demand or periodically in the background.
+    # Only one process should add references to a given model, but any
+    # number of processes may load it.
+
+    def __init__(self, modelPath, binsPerChannel=256,
+                 syncEachAppend=True):
+
+        HC.HistogramClassifier.__init__(self, binsPerChannel)
+
+        if os.path.splitext(modelPath)[1].lower() == '.mat':
+            raise ValueError(
+                    'An incremental model must use the memory-mapped '
+                    'format, not the MAT format: %s' % modelPath)
+
+        # Whether to flush each appended reference to disk before
+        # returning. Otherwise, a crash may lose recent references,
+        # though it still cannot corrupt the model.
+        self.syncEachAppend = syncEachAppend
+
+        self._modelPath = modelPath
+        self._lock = threading.RLock()
+        self._compactionLock = threading.Lock()
+        self._compactionThread = None
+        self._compactionStopEvent = threading.Event()
+        self._numPendingReferences = 0
+
+        if os.path.exists(modelPath):
+            # Load the model and any pending segments.
+            self.deserialize(modelPath)
+            self._numPendingReferences = sum(
+                    len(HC.readSegment(path)[0]) for generation, path in
+                    HC.listSegments(modelPath,
+                                    HC.readModelGeneration(modelPath)))
+        else:
+            # Create an empty model so that other processes can load it.
+            HC.writeMappedModel(modelPath, self._binsPerChannel, {})
+
+        # Append to a new segment, which is created by the first
+        # append so that no empty segments are left behind. Any torn
+        # record at the end of an older segment is left behind, where
+        # readers ignore it.
+        self._segmentFile = None
+
+    @property
+    def modelPath(self):
+        return self._modelPath
+
+    @property
+    def numPendingReferences(self):
+        return self._numPendingReferences
+
+    def addReferenceHist(self, hist, label):
+        record = HC.encodeSegmentRecord(self._binsPerChannel, label, hist)
+        with self._lock:
+            if self._segmentFile is None:
+                self._segmentFile = open(
+                        HC.segmentPath(self._modelPath, self._generation),
+                        'ab')
+            # Write the whole record at once. If it is torn by a crash,
+            # its checksum will not match and readers will ignore it.
+            self._segmentFile.write(record)
+            self._segmentFile.flush()
+            if self.syncEachAppend:
+                os.fsync(self._segmentFile.fileno())
+            HC.HistogramClassifier.addReferenceHist(self, hist, label)
+            self._numPendingReferences += 1
+
+    def classifyWithSimilarities(self, queryImage, queryImageName=None):
+        with self._lock:
+            return HC.HistogramClassifier.classifyWithSimilarities(
+                    self, queryImage, queryImageName)
+
+    def compact(self):
+        with self._compactionLock:
+            with self._lock:
+                if self._numPendingReferences == 0:
+                    return False
+                # Take a snapshot of the references and direct new
+                # references to the next generation of segment.
+                references = dict(
+                        (label, list(referenceHists))
+                        for label, referenceHists in
+                        self._references.items())
+                numCompactedReferences = self._numPendingReferences
+                generation = self._generation + 1
+                if self._segmentFile is not None:
+                    self._segmentFile.close()
+                    self._segmentFile = None
+                self._generation = generation
+            # Write the model without blocking new references. The
+            # model replaces the old one atomically. Until it does,
+            # readers still find the old model and all of the segments.
+            # On Windows, the replacement fails while the old model is
+            # mapped by any process.
+            HC.writeMappedModel(self._modelPath, self._binsPerChannel,
+                                references, generation)
+            with self._lock:
+                self._numPendingReferences -= numCompactedReferences
+            # Delete the segments that are now part of the model.
+            for oldGeneration, path in HC.listSegments(self._modelPath):
+                if oldGeneration < generation:
+                    os.remove(path)
+            return True
+
+    def _getSharedModelPath(self):
+        # Every reference is in the model or its segments.
+        return os.path.abspath(self._modelPath)
+
+    def serialize(self, path, compressed=False):
+        if os.path.abspath(path) == os.path.abspath(self._modelPath):
+            # Rewriting the model is the same as compacting it.
+            self.compact()
+            return
+        with self._lock:
+            HC.HistogramClassifier.serialize(self, path, compressed)
+
+    def startCompaction(self, interval=3600.0):
+        # Compact the model periodically in a background thread.
+        self.stopCompaction()
+        self._compactionStopEvent.clear()
+        self._compactionThread = threading.Thread(
+                target=self._compactPeriodically, args=(interval,))
+        self._compactionThread.daemon = True
+        self._compactionThread.start()
+
+    def stopCompaction(self):
+        if self._compactionThread is not None:
+            self._compactionStopEvent.set()
+            self._compactionThread.join()
+            self._compactionThread = None
+
+    def _compactPeriodically(self, interval):
+        while not self._compactionStopEvent.wait(interval):
+            try:
+                self.compact()
+            except Exception as e:
+                sys.stderr.write(
+                        'Error when compacting %s:\n' % self._modelPath)
+                sys.stderr.write('%s\n' % str(e))
+
+    def close(self):
+        self.stopCompaction()
+        with self._lock:
+            if self._segmentFile is not None:
+                self._segmentFile.close()
+                self._segmentFile = None
+
+def main():
+    classifier = IncrementalHistogramClassifier('incremental.hist')
+    classifier.verbose = True
+    classifier.addReferenceFromFile(
+            'images/communal_apartments_01.jpg',
+            'Stalinist, interior')
+    classifier.addReferenceFromFile(
+            'images/dubai_damac_heights.jpg',
+            'Luxury, interior')
+    print('Pending references: %d' % classifier.numPendingReferences)
+    classifier.compact()
+    print('Pending references: %d' % classifier.numPendingReferences)
+    classifier.classifyFromFile('images/communal_apartments_04.jpg')
+    classifier.close()
+
+if __name__ == '__main__':
+    main()
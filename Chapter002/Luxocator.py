@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 
 
+import time
+
+# Measure the time to import the other modules.
+_importStartTime = time.time()
+
 import numpy # Hint to PyInstaller
 import cv2
 import os
+import sys
 import threading
 import wx
 
+from ClassifierClient import ClassifierClient
 from HistogramClassifier import HistogramClassifier
-from ImageSearchSession import ImageSearchSession
+from ImageSearchSession import ImageSearchSession, SearchResultCache
 import PyInstallerUtils
+import RequestsUtils
 import ResizeUtils
 import WxUtils
 
@@ -18,7 +26,9 @@ class Luxocator(wx.Frame):
 
     def __init__(self, classifierPath, maxImageSize=768,
                  verboseSearchSession=False,
-                 verboseClassifier=False):
+                 verboseClassifier=False,
+                 classifierDaemonAddress=None,
+                 progressive=True):
 
         style = wx.CLOSE_BOX | wx.MINIMIZE_BOX | wx.CAPTION | \
             wx.SYSTEM_MENU | wx.CLIP_CHILDREN
@@ -26,17 +36,37 @@ class Luxocator(wx.Frame):
         self.SetBackgroundColour(wx.Colour(232, 232, 232))
 
         self._maxImageSize = maxImageSize
+        # Whether to show each result's thumbnail, with a provisional
+        # label, while its full image downloads.
+        self._progressive = progressive
         border = 12
         defaultQuery = 'luxury condo sales'
 
+        # Whether to print the time taken by each stage of startup.
+        self._reportStartup = bool(
+                os.environ.get('LUXOCATOR_STARTUP_REPORT'))
+        self._hasShownImage = False
+        self._hasShownFullImage = False
+        self._numUpdates = 0
+        self._isShowingFullImage = False
+
         self._index = 0
         self._session = ImageSearchSession()
         self._session.verbose = verboseSearchSession
-        self._session.search(defaultQuery)
-
-        self._classifier = HistogramClassifier()
-        self._classifier.verbose = verboseClassifier
-        self._classifier.deserialize(classifierPath)
+        # Prepare the neighboring images while the user looks at one.
+        self._session.prefetchRadius = 2
+        # Decode large images at no more than the size that is shown.
+        self._session.targetImageSize = maxImageSize
+        # Keep pages of results on disk, so that paging back and forth,
+        # and repeating queries, do not use the search API.
+        self._session.searchResultCache = SearchResultCache(
+                os.path.join(os.path.expanduser('~'), '.luxocator',
+                             'searches'))
+
+        # The classifier is loaded in the background, along with the
+        # first search, so that the window appears immediately.
+        self._classifier = None
+        self._verboseClassifier = verboseClassifier
 
         self.Bind(wx.EVT_CLOSE, self._onCloseWindow)
 
@@ -60,6 +90,7 @@ class Luxocator(wx.Frame):
                               self._onSearchCanceled)
 
         self._labelStaticText = wx.StaticText(self)
+        self._labelColour = self._labelStaticText.GetForegroundColour()
 
         self._prevButton = wx.Button(self, label='Prev')
         self._prevButton.Bind(wx.EVT_BUTTON,
@@ -94,6 +125,70 @@ class Luxocator(wx.Frame):
 
         self.SetSizerAndFit(self._rootSizer)
 
+        self._labelStaticText.SetLabel('Loading...')
+        self._disableControls()
+        wx.BeginBusyCursor()
+        loadThread = threading.Thread(
+                target=self._loadAsync,
+                args=(classifierPath, classifierDaemonAddress,
+                      defaultQuery))
+        # Do not keep the app alive if the window is closed first.
+        loadThread.daemon = True
+        loadThread.start()
+
+    def reportStartupTime(self, stage, seconds):
+        # Print the duration of a stage of startup, or for the frame,
+        # the first pixels and the first full image, the time since the
+        # imports began.
+        if self._reportStartup:
+            sys.stderr.write('Startup: %-14s %7.3f s\n' % \
+                             (stage, seconds))
+
+    def _loadAsync(self, classifierPath, classifierDaemonAddress,
+                   defaultQuery):
+        # Search while the classifier loads.
+        def search():
+            startTime = time.time()
+            self._session.search(defaultQuery)
+            self.reportStartupTime('first search',
+                                   time.time() - startTime)
+        searchThread = threading.Thread(target=search)
+        searchThread.start()
+        classifier = None
+        error = None
+        try:
+            startTime = time.time()
+            if classifierDaemonAddress is None:
+                classifier = HistogramClassifier()
+                classifier.deserialize(classifierPath)
+            else:
+                # Use a classifier daemon's model instead of loading one.
+                classifier = ClassifierClient(classifierDaemonAddress)
+            classifier.verbose = self._verboseClassifier
+            self.reportStartupTime('model load', time.time() - startTime)
+        except Exception as e:
+            sys.stderr.write('Failed to load the classifier:\n')
+            sys.stderr.write('%s\n' % str(e))
+            classifier = None
+            error = e
+        finally:
+            searchThread.join()
+            # Finish on the main thread, even if loading failed, so that
+            # the busy cursor ends.
+            wx.CallAfter(self._loadResync, classifier, error)
+
+    def _loadResync(self, classifier, error):
+        try:
+            if error is None:
+                self._classifier = classifier
+                self._session.prefetchClassifier = classifier
+        finally:
+            wx.EndBusyCursor()
+        if error is not None:
+            wx.MessageBox('Failed to load the classifier:\n%s' % error,
+                          'Luxocator', wx.OK | wx.ICON_ERROR, self)
+            self.Close()
+            return
         self._updateImageAndControls()
 
     @property
@@ -106,11 +201,13 @@ class Luxocator(wx.Frame):
 
     @property
     def verboseClassifier(self):
-        return self._classifier.verbose
+        return self._verboseClassifier
 
     @verboseClassifier.setter
     def verboseClassifier(self, value):
-        self._classifier.verbose = value
+        self._verboseClassifier = value
+        if self._classifier is not None:
+            self._classifier.verbose = value
 
     def _onCloseWindow(self, event):
         self.Destroy()
@@ -159,6 +256,8 @@ class Luxocator(wx.Frame):
         self._disableControls()
         # Show the busy cursor.
         wx.BeginBusyCursor()
+        self._numUpdates += 1
+        self._isShowingFullImage = False
         # Get the image in a background thread.
         threading.Thread(
                 target=self._updateImageAndControlsAsync).start()
@@ -168,15 +267,21 @@ class Luxocator(wx.Frame):
             image = None
             label = 'Search had no results'
         else:
+            index = self._index % self._session.numResultsRequested
+            if self._progressive and not self._session.isCached(index):
+                # Get the thumbnail while the full image downloads.
+                threading.Thread(target=self._showThumbnailAsync,
+                                 args=(index, self._numUpdates)).start()
             # Get the current image.
-            image, url = self._session.getCvImageAndUrl(
-                self._index % self._session.numResultsRequested)
+            image, url, label = self._session.getCvImageUrlAndLabel(index)
             if image is None:
                 # Provide an error message.
                 label = 'Failed to decode image'
             else:
-                # Classify the image.
-                label = self._classifier.classify(image, url)
+                if label is None:
+                    # The image was not classified in advance, so
+                    # classify it now.
+                    label = self._classifier.classify(image, url)
                 # Resize the image while maintaining its aspect ratio.
                 image = ResizeUtils.cvResizeAspectFill(
                     image, self._maxImageSize)
@@ -184,9 +289,34 @@ class Luxocator(wx.Frame):
         wx.CallAfter(self._updateImageAndControlsResync, image,
                      label)
 
+    def _showThumbnailAsync(self, index, numUpdates):
+        thumbnail, url = self._session.getCvImageAndUrl(
+                index, useThumbnail=True)
+        if thumbnail is None:
+            return
+        # Classify the thumbnail, provisionally.
+        label = self._classifier.classify(thumbnail, url)
+        thumbnail = ResizeUtils.cvResizeAspectFill(
+                thumbnail, self._maxImageSize)
+        wx.CallAfter(self._showThumbnailResync, thumbnail, label,
+                     numUpdates)
+
+    def _showThumbnailResync(self, thumbnail, label, numUpdates):
+        # Show the thumbnail unless the full image, or another result,
+        # has been shown since it was requested.
+        if numUpdates == self._numUpdates and \
+                not self._isShowingFullImage:
+            self._showImageAndLabel(thumbnail, label, True)
+
     def _updateImageAndControlsResync(self, image, label):
         # Hide the busy cursor.
         wx.EndBusyCursor()
+        self._showImageAndLabel(image, label)
+        self._isShowingFullImage = True
+        # Re-enable the controls.
+        self._enableControls()
+
+    def _showImageAndLabel(self, image, label, provisional=False):
         if image is None:
             # Provide a black bitmap.
             bitmap = wx.Bitmap(self._maxImageSize,
@@ -196,23 +326,49 @@ class Luxocator(wx.Frame):
             bitmap = WxUtils.wxBitmapFromCvImage(image)
         # Show the bitmap.
         self._staticBitmap.SetBitmap(bitmap)
-        # Show the label.
-        self._labelStaticText.SetLabel(label)
+        # Show the label, marking it and greying it out if it is
+        # provisional.
+        if provisional:
+            self._labelStaticText.SetLabel(
+                    '%s (provisional, from thumbnail)' % label)
+            self._labelStaticText.SetForegroundColour(
+                    wx.Colour(128, 128, 128))
+        else:
+            self._labelStaticText.SetLabel(label)
+            self._labelStaticText.SetForegroundColour(self._labelColour)
         # Resize the sizer and frame.
         self._rootSizer.Fit(self)
-        # Re-enable the controls.
-        self._enableControls()
         # Refresh.
         self.Refresh()
+        if not self._hasShownImage:
+            self._hasShownImage = True
+            self.reportStartupTime('first pixels',
+                                   time.time() - _importStartTime)
+        if not provisional and not self._hasShownFullImage:
+            self._hasShownFullImage = True
+            self.reportStartupTime('first image',
+                                   time.time() - _importStartTime)
 
 def main():
+    importTime = time.time() - _importStartTime
     os.environ['REQUESTS_CA_BUNDLE'] = \
             PyInstallerUtils.resourcePath('cacert.pem')
+    # Keep downloaded images on disk, so that revisited queries load
+    # quickly.
+    RequestsUtils.setDiskCache(RequestsUtils.DiskCache(
+            os.path.join(os.path.expanduser('~'), '.luxocator', 'cache')))
     app = wx.App()
+    # If LUXOCATOR_CLASSIFIER_DAEMON is an http:// URL or the path of
+    # a Unix domain socket, classify via the daemon there.
     luxocator = Luxocator(
-            PyInstallerUtils.resourcePath('classifier.mat'),
-            verboseSearchSession=False, verboseClassifier=False)
+            PyInstallerUtils.resourcePath('classifier.hist'),
+            verboseSearchSession=False, verboseClassifier=False,
+            classifierDaemonAddress=os.environ.get(
+                    'LUXOCATOR_CLASSIFIER_DAEMON'))
     luxocator.Show()
+    luxocator.reportStartupTime('imports', importTime)
+    luxocator.reportStartupTime('frame shown',
+                                time.time() - _importStartTime)
     app.MainLoop()
 
 if __name__ == '__main__':
@@ -9,7 +9,7 @@ a = Analysis(['Luxocator.py'],
 a.datas.append(('cacert.pem', 'cacert.pem', 'DATA'))
 
 # Include our app's classifier data.
-a.datas.append(('classifier.mat', 'classifier.mat', 'DATA'))
+a.datas.append(('classifier.hist', 'classifier.hist', 'DATA'))
 
 
 pyz = PYZ(a.pure)
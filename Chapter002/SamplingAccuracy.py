@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+
+import argparse
+import glob
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import time
+
+import HistogramClassifier as HC
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Compare histograms of sampled images to '
+                        'histograms of full-resolution images, in terms '
+                        'of similarity to each other, similarity to a '
+                        'model\'s labels, and the chosen labels.')
+    parser.add_argument('--images', dest='imageDir', default='images')
+    parser.add_argument('--model', dest='modelPath',
+                        default='classifier.hist',
+                        help='skip the comparison of labels if the model '
+                             'does not exist')
+    parser.add_argument('--budgets', type=int, nargs='+',
+                        default=[1000000, 250000, 100000, 25000],
+                        help='maximum numbers of pixels to sample')
+    args = parser.parse_args()
+
+    classifier = HC.HistogramClassifier()
+    if os.path.exists(args.modelPath):
+        binsPerChannel = HC.readModel(args.modelPath)[0]
+        classifier = HC.HistogramClassifier(binsPerChannel)
+        classifier.deserialize(args.modelPath)
+    else:
+        print('Model %s does not exist so labels will not be compared' % \
+              args.modelPath)
+
+    # Classify the full-resolution images.
+    images = []
+    for path in sorted(glob.glob(os.path.join(args.imageDir, '*.jpg'))):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        startTime = time.time()
+        hist = classifier.createHist(image)
+        histTime = time.time() - startTime
+        label, similarities = classifier.classifyWithSimilarities(image)
+        images.append((image, hist, histTime, label, similarities))
+    fullHistTime = sum(image[2] for image in images) / len(images)
+    print('%d images, mean full-resolution histogram time %.2f ms' % \
+          (len(images), 1000.0 * fullHistTime))
+
+    print('%-8s %9s %9s %10s %11s %11s %9s' % (
+          'sampling', 'budget', 'time (ms)', 'self-sim', 'mean |dsim|',
+          'max |dsim|', 'labels'))
+    for sampling in ('stride', 'area'):
+        for budget in args.budgets:
+            classifier.histSampling = sampling
+            classifier.maxHistPixels = budget
+            histTime = 0.0
+            selfSimilarity = 0.0
+            similarityErrors = []
+            numSameLabels = 0
+            for image, fullHist, fullHistTime, fullLabel, \
+                    fullSimilarities in images:
+                startTime = time.time()
+                hist = classifier.createHist(image)
+                histTime += time.time() - startTime
+                selfSimilarity += HC.intersectSparseHists(hist, fullHist)
+                label, similarities = classifier.classifyWithSimilarities(
+                        image)
+                for otherLabel in fullSimilarities:
+                    similarityErrors.append(
+                            abs(similarities[otherLabel] -
+                                fullSimilarities[otherLabel]))
+                if label == fullLabel:
+                    numSameLabels += 1
+            if not similarityErrors:
+                similarityErrors = [0.0]
+            print('%-8s %9d %9.2f %10.4f %11.5f %11.5f %8.1f%%' % (
+                  sampling, budget, 1000.0 * histTime / len(images),
+                  selfSimilarity / len(images),
+                  numpy.mean(similarityErrors),
+                  numpy.max(similarityErrors),
+                  100.0 * numSameLabels / len(images)))
+
+if __name__ == '__main__':
+    main()
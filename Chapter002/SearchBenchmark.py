@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+
+import argparse
+import json
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import subprocess
+import sys
+import time
+
+import HistogramClassifier as HC
+from ImageSearchSession import ImageSearchSession, SearchResultCache
+import RequestsUtils
+import SearchStandIn
+
+
+DEFAULT_QUERIES = ['luxury condo sales', 'communal apartments',
+                   'tropical beach', 'snowy forest']
+
+
+def summarize(seconds):
+    # Return the count, mean and percentiles of a list of durations.
+    seconds = numpy.array(seconds)
+    summary = {'count': len(seconds)}
+    for name, percentile in (('p50', 50), ('p95', 95), ('p99', 99)):
+        summary[name] = float(numpy.percentile(seconds, percentile)) \
+                if len(seconds) > 0 else None
+    summary['mean'] = float(seconds.mean()) if len(seconds) > 0 else None
+    return summary
+
+def startStandIn(args):
+    # Run the stand-in in a child process, so that it does not compete
+    # with the benchmark for the GIL, and return the process and its
+    # search URL.
+    command = [sys.executable, os.path.abspath(SearchStandIn.__file__),
+               '--port', '0',
+               '--images', args.imageDir,
+               '--synthetic-size', str(args.syntheticSize[0]),
+               str(args.syntheticSize[1]),
+               '--search-latency', str(args.searchLatency),
+               '--image-latency', str(args.imageLatency),
+               '--latency-jitter', str(args.latencyJitter),
+               '--total-matches', str(args.totalEstimatedMatches)]
+    if args.syntheticCount:
+        command += ['--synthetic', str(args.syntheticCount)]
+    if args.bandwidth is not None:
+        command += ['--bandwidth', str(args.bandwidth)]
+    if args.searchesPerSecond is not None:
+        command += ['--searches-per-second', str(args.searchesPerSecond)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = process.stdout.readline().decode('utf-8')
+    if not line:
+        process.wait()
+        raise RuntimeError('The stand-in failed to start')
+    return process, line.split()[-1]
+
+def runBenchmark(args, searchUrl):
+    binsPerChannel = HC.readModel(args.modelPath)[0]
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    classifier.useBinIndex = args.useBinIndex
+    classifier.deserialize(args.modelPath)
+
+    session = ImageSearchSession()
+    session.searchUrl = searchUrl
+    # Measure every search, unless the cache is part of the experiment.
+    session.searchResultCache = SearchResultCache() \
+            if args.useSearchCache else None
+    session.prefetchRadius = args.prefetchRadius
+    session.prefetchClassifier = classifier
+    session.targetImageSize = args.targetImageSize
+    # Search at the stand-in's quota, if it has one.
+    session.searchesPerSecond = args.searchesPerSecond
+
+    searchSeconds = []
+    firstLabelSeconds = []
+    timeToLabelSeconds = []
+    numFailures = 0
+    startTime = time.time()
+    for repetition in range(args.repetitions):
+        for query in args.queries:
+            searchStartTime = time.time()
+            session.search(query, args.resultsPerQuery)
+            searchSeconds.append(time.time() - searchStartTime)
+            numResults = min(session.numResultsReceived,
+                             args.resultsPerQuery)
+            for index in range(numResults):
+                # Time each result as Luxocator shows it: from the
+                # request for the result until its label is known.
+                resultStartTime = time.time()
+                image, url, label = session.getCvImageUrlAndLabel(index)
+                if image is None:
+                    numFailures += 1
+                    continue
+                if label is None:
+                    label = classifier.classify(image, url)
+                endTime = time.time()
+                timeToLabelSeconds.append(endTime - resultStartTime)
+                if index == 0:
+                    firstLabelSeconds.append(endTime - searchStartTime)
+                if args.thinkTime > 0.0:
+                    # The user looks at the result before the next.
+                    time.sleep(args.thinkTime)
+    elapsedSeconds = time.time() - startTime
+
+    return {
+        'version': 1,
+        'timestamp': time.time(),
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'opencv': cv2.__version__,
+        'searchUrl': searchUrl,
+        'settings': {
+            'queries': args.queries,
+            'repetitions': args.repetitions,
+            'resultsPerQuery': args.resultsPerQuery,
+            'prefetchRadius': args.prefetchRadius,
+            'targetImageSize': args.targetImageSize,
+            'thinkTime': args.thinkTime,
+            'useSearchCache': args.useSearchCache,
+            'useBinIndex': args.useBinIndex,
+            'searchLatency': args.searchLatency,
+            'imageLatency': args.imageLatency,
+            'latencyJitter': args.latencyJitter,
+            'bandwidth': args.bandwidth,
+            'syntheticCount': args.syntheticCount
+        },
+        'elapsedSeconds': elapsedSeconds,
+        'failures': numFailures,
+        'searchSeconds': summarize(searchSeconds),
+        'firstLabelSeconds': summarize(firstLabelSeconds),
+        'timeToLabelSeconds': summarize(timeToLabelSeconds),
+        'connections': RequestsUtils.connectionStats()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Measure the time from requesting each search '
+                        'result to knowing its label, by driving '
+                        'ImageSearchSession and a HistogramClassifier '
+                        'against a local stand-in for the image search '
+                        'API, or against another endpoint. The results '
+                        'are written as JSON.')
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+    parser.add_argument('--model', dest='modelPath',
+                        default='classifier.hist')
+    parser.add_argument('--output', '-o',
+                        help='write the JSON here instead of to stdout')
+    parser.add_argument('--url', dest='searchUrl',
+                        help='use this search endpoint instead of '
+                             'starting a stand-in')
+    parser.add_argument('--repetitions', type=int, default=1)
+    parser.add_argument('--results-per-query', dest='resultsPerQuery',
+                        type=int, default=20)
+    parser.add_argument('--prefetch-radius', dest='prefetchRadius',
+                        type=int, default=2)
+    parser.add_argument('--target-size', dest='targetImageSize', type=int,
+                        default=768,
+                        help='decode JPEGs at a reduced resolution whose '
+                             'larger dimension is at least this, or at '
+                             'full resolution if 0')
+    parser.add_argument('--think-time', dest='thinkTime', type=float,
+                        default=0.0,
+                        help='seconds to wait after each result')
+    parser.add_argument('--search-cache', dest='useSearchCache',
+                        action='store_true')
+    parser.add_argument('--bin-index', dest='useBinIndex',
+                        action='store_true')
+    SearchStandIn.addArguments(parser)
+    args = parser.parse_args()
+    args.targetImageSize = args.targetImageSize or None
+
+    process = None
+    searchUrl = args.searchUrl
+    if searchUrl is None:
+        process, searchUrl = startStandIn(args)
+        # The stand-in accepts any key.
+        os.environ.setdefault('BING_SEARCH_KEY', 'stand-in')
+    try:
+        report = runBenchmark(args, searchUrl)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+
+import argparse
+import glob
+import hashlib
+import json
+import numpy # Hint to PyInstaller
+import cv2
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socketserver
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import SocketServer as socketserver
+    from urlparse import parse_qs, urlparse
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8766
+
+SEARCH_PATH = '/bing/v7.0/images/search'
+
+THUMBNAIL_SIZE = 300
+
+# The bodies are written in chunks, so that the bandwidth is limited
+# smoothly.
+CHUNK_BYTES = 16*1024
+
+
+class _Image(object):
+
+    __slots__ = ('data', 'width', 'height', 'thumbnailData',
+                 'thumbnailWidth', 'thumbnailHeight')
+
+    def __init__(self, image, data=None):
+        h, w = image.shape[:2]
+        if data is None:
+            data = cv2.imencode('.jpg', image)[1].tobytes()
+        self.data = data
+        self.width = w
+        self.height = h
+        scale = min(1.0, float(THUMBNAIL_SIZE) / max(w, h))
+        thumbnail = cv2.resize(image, (max(1, int(w * scale)),
+                                       max(1, int(h * scale))),
+                               interpolation=cv2.INTER_AREA)
+        self.thumbnailData = cv2.imencode('.jpg', thumbnail)[1].tobytes()
+        self.thumbnailHeight, self.thumbnailWidth = thumbnail.shape[:2]
+
+def loadRecordedImages(imageDir):
+    # Return the JPEGs in a folder, served exactly as they were
+    # recorded.
+    images = []
+    for path in sorted(glob.glob(os.path.join(imageDir, '*.jpg'))):
+        with open(path, 'rb') as file:
+            data = file.read()
+        image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8),
+                             cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append(_Image(image, data))
+    if not images:
+        raise ValueError('Found no JPEGs in %s' % imageDir)
+    return images
+
+def createSyntheticImages(count, width, height, seed=0):
+    # Return JPEGs of smooth random colors, which compress and classify
+    # more like photos than noise does.
+    random = numpy.random.RandomState(seed)
+    images = []
+    for i in range(count):
+        small = random.randint(0, 256, (6, 8, 3)).astype(numpy.uint8)
+        image = cv2.resize(small, (width, height),
+                           interpolation=cv2.INTER_CUBIC)
+        noise = random.normal(0.0, 8.0, image.shape)
+        image = numpy.clip(image + noise, 0, 255).astype(numpy.uint8)
+        images.append(_Image(image))
+    return images
+
+class StandInSettings(object):
+
+    # The behavior of the stand-in. Latencies are in seconds, and each
+    # is varied randomly by up to latencyJitter times itself. Bandwidth
+    # is in bytes per second per response, or unlimited if None. If
+    # searchesPerSecond is not None, searches beyond that rate receive
+    # 429 responses with Retry-After, as Bing's do.
+
+    def __init__(self):
+        self.searchLatency = 0.2
+        self.imageLatency = 0.1
+        self.latencyJitter = 0.5
+        self.bandwidth = None
+        self.totalEstimatedMatches = 1000
+        self.searchesPerSecond = None
+        self.key = None
+
+class _RateLimiter(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windowStart = 0.0
+        self._count = 0
+
+    def retryAfter(self, ratePerSecond):
+        # Return 0 if a request is allowed in the current one-second
+        # window, or else the seconds until the next window.
+        with self._lock:
+            now = time.time()
+            if now - self._windowStart >= 1.0:
+                self._windowStart = now
+                self._count = 0
+            if self._count < ratePerSecond:
+                self._count += 1
+                return 0.0
+            return self._windowStart + 1.0 - now
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    # GET SEARCH_PATH?q=QUERY&count=N&offset=M returns a page of results
+    # in the format of Bing's v7 image search. Each result's image and
+    # thumbnail are served from /images/ and /thumbnails/. The image of
+    # a result depends only on its query and position.
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        if url.path == SEARCH_PATH:
+            self._search(parse_qs(url.query))
+        elif url.path.startswith('/images/') or \
+                url.path.startswith('/thumbnails/'):
+            try:
+                index = int(os.path.splitext(
+                        os.path.basename(url.path))[0])
+                image = server.images[index]
+            except (ValueError, IndexError):
+                self._sendJson(404, {'message': 'Not found: %s' % url.path})
+                return
+            self._delay(server.settings.imageLatency)
+            if url.path.startswith('/images/'):
+                self._send(200, 'image/jpeg', image.data)
+            else:
+                self._send(200, 'image/jpeg', image.thumbnailData)
+        else:
+            self._sendJson(404, {'message': 'Not found: %s' % url.path})
+
+    def _search(self, params):
+        server = self.server
+        settings = server.settings
+        key = self.headers.get('Ocp-Apim-Subscription-Key')
+        if not key or (settings.key is not None and key != settings.key):
+            self._sendJson(401, {'message': 'Access denied due to invalid '
+                                            'subscription key.'})
+            return
+        if settings.searchesPerSecond is not None:
+            retryAfter = server.rateLimiter.retryAfter(
+                    settings.searchesPerSecond)
+            if retryAfter > 0.0:
+                seconds = max(1, int(retryAfter + 0.999))
+                server.countRequest('rateLimited')
+                self._sendJson(429, {'message': 'Rate limit is exceeded. '
+                                                'Try again in %d seconds.' % \
+                                                seconds},
+                               {'Retry-After': str(seconds)})
+                return
+        try:
+            query = params['q'][0]
+            count = min(150, int(params.get('count', ['35'])[0]))
+            offset = int(params.get('offset', ['0'])[0])
+        except (KeyError, ValueError):
+            self._sendJson(400, {'message': 'Malformed query: %s' % \
+                                            self.path})
+            return
+        self._delay(settings.searchLatency)
+        server.countRequest('searches')
+        baseUrl = 'http://%s' % self.headers.get(
+                'Host', '%s:%d' % server.server_address[:2])
+        numResults = max(0, min(count,
+                                settings.totalEstimatedMatches - offset))
+        value = [self._result(baseUrl, query, position)
+                 for position in range(offset, offset + numResults)]
+        self._sendJson(200, {
+            '_type': 'Images',
+            'readLink': '%s%s?q=%s' % (baseUrl, SEARCH_PATH, query),
+            'webSearchUrl': 'https://www.bing.com/images/search?q=%s' % \
+                    query,
+            'totalEstimatedMatches': settings.totalEstimatedMatches,
+            'nextOffset': offset + numResults,
+            'value': value
+        })
+
+    def _result(self, baseUrl, query, position):
+        key = hashlib.sha1(('%s\n%d' % (query, position)).encode(
+                'utf-8')).hexdigest()
+        index = int(key[:8], 16) % len(self.server.images)
+        image = self.server.images[index]
+        return {
+            'name': '%s %d' % (query, position),
+            'webSearchUrl': 'https://www.bing.com/images/search?id=%s' % \
+                    key,
+            'thumbnailUrl': '%s/thumbnails/%d.jpg?id=%s' % \
+                    (baseUrl, index, key),
+            'contentUrl': '%s/images/%d.jpg?id=%s' % (baseUrl, index, key),
+            'hostPageUrl': '%s/pages/%s.html' % (baseUrl, key),
+            'contentSize': '%d B' % len(image.data),
+            'encodingFormat': 'jpeg',
+            'hostPageDisplayUrl': '%s/pages/%s.html' % (baseUrl, key),
+            'width': image.width,
+            'height': image.height,
+            'thumbnail': {
+                'width': image.thumbnailWidth,
+                'height': image.thumbnailHeight
+            },
+            'imageInsightsToken': 'ccid_%s' % key[:8],
+            'imageId': key,
+            'accentColor': '808080'
+        }
+
+    def _delay(self, latency):
+        if latency > 0.0:
+            jitter = self.server.settings.latencyJitter
+            time.sleep(latency * random.uniform(1.0 - jitter, 1.0 + jitter))
+
+    def _sendJson(self, status, obj, headers=None):
+        self._send(status, 'application/json',
+                   json.dumps(obj).encode('utf-8'), headers)
+
+    def _send(self, status, contentType, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        bandwidth = self.server.settings.bandwidth
+        if bandwidth is None:
+            self.wfile.write(body)
+            return
+        startTime = time.time()
+        for start in range(0, len(body), CHUNK_BYTES):
+            self.wfile.write(body[start:start + CHUNK_BYTES])
+            # Wait until the bytes written so far are within the
+            # bandwidth.
+            delay = startTime + float(start + CHUNK_BYTES) / bandwidth - \
+                    time.time()
+            if delay > 0.0:
+                time.sleep(delay)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    # A local imitation of Bing's v7 image search API and of the hosts
+    # of its images, for testing and benchmarking without the live API.
+
+    daemon_threads = True
+
+    def __init__(self, images, settings=None, host=DEFAULT_HOST,
+                 port=DEFAULT_PORT, verbose=False):
+        HTTPServer.__init__(self, (host, port), _RequestHandler)
+        self.images = images
+        self.settings = settings or StandInSettings()
+        self.verbose = verbose
+        self.rateLimiter = _RateLimiter()
+        self._countsLock = threading.Lock()
+        self._counts = {'searches': 0, 'rateLimited': 0}
+
+    @property
+    def searchUrl(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, SEARCH_PATH)
+
+    def countRequest(self, name):
+        with self._countsLock:
+            self._counts[name] += 1
+
+    def counts(self):
+        with self._countsLock:
+            return dict(self._counts)
+
+def addArguments(parser):
+    # Add the arguments that configure the stand-in to a parser.
+    parser.add_argument('--images', dest='imageDir', default='images',
+                        help='serve the JPEGs in this folder')
+    parser.add_argument('--synthetic', dest='syntheticCount', type=int,
+                        help='serve this many synthetic JPEGs instead')
+    parser.add_argument('--synthetic-size', dest='syntheticSize', type=int,
+                        nargs=2, default=(1024, 768),
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--search-latency', dest='searchLatency',
+                        type=float, default=0.2,
+                        help='seconds before each page of results')
+    parser.add_argument('--image-latency', dest='imageLatency',
+                        type=float, default=0.1,
+                        help='seconds before each image')
+    parser.add_argument('--latency-jitter', dest='latencyJitter',
+                        type=float, default=0.5,
+                        help='vary each latency randomly by up to this '
+                             'fraction')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bytes per second per response (default: '
+                             'unlimited)')
+    parser.add_argument('--total-matches', dest='totalEstimatedMatches',
+                        type=int, default=1000)
+    parser.add_argument('--searches-per-second', dest='searchesPerSecond',
+                        type=int,
+                        help='respond 429 to searches beyond this rate')
+
+def createServer(args, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 verbose=False):
+    if args.syntheticCount:
+        width, height = args.syntheticSize
+        images = createSyntheticImages(args.syntheticCount, width, height)
+    else:
+        images = loadRecordedImages(args.imageDir)
+    settings = StandInSettings()
+    settings.searchLatency = args.searchLatency
+    settings.imageLatency = args.imageLatency
+    settings.latencyJitter = args.latencyJitter
+    settings.bandwidth = args.bandwidth
+    settings.totalEstimatedMatches = args.totalEstimatedMatches
+    settings.searchesPerSecond = args.searchesPerSecond
+    return StandInServer(images, settings, host, port, verbose)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Imitate Bing\'s v7 image search API locally, '
+                        'serving recorded or synthetic images with '
+                        'configurable latency and bandwidth. Point '
+                        'ImageSearchSession at it by setting '
+                        'BING_SEARCH_URL to the URL that is printed.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='listen on this port, or any free port if 0')
+    parser.add_argument('--verbose', action='store_true')
+    addArguments(parser)
+    args = parser.parse_args()
+
+    server = createServer(args, args.host, args.port, args.verbose)
+    print('Serving image search on %s' % server.searchUrl)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import numpy
+import cv2
+import pytest
+import threading
+
+import HistogramClassifier as HC
+
+
+def _createImages(count, seed=0):
+    # Smooth random colors, which have realistic, overlapping
+    # histograms.
+    random = numpy.random.RandomState(seed)
+    images = []
+    for i in range(count):
+        small = random.randint(0, 256, (4, 5, 3)).astype(numpy.uint8)
+        image = cv2.resize(small, (80, 60), interpolation=cv2.INTER_CUBIC)
+        noise = random.normal(0.0, 6.0, image.shape)
+        images.append(numpy.clip(image + noise, 0, 255).astype(numpy.uint8))
+    # Include saturated pixels, which every bin count must count.
+    images[0][:5, :5] = 255
+    return images
+
+def _createClassifier(binsPerChannel, images, numLabels=3):
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    for i, image in enumerate(images):
+        classifier.addReference(image, 'label%d' % (i % numLabels))
+    return classifier
+
+def _runConcurrently(function, numThreads=8):
+    # Start every thread's call at once and return each thread's result.
+    barrier = threading.Barrier(numThreads)
+    results = [None] * numThreads
+    def run(i):
+        barrier.wait()
+        results[i] = function()
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(numThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _createHists(classifier, image):
+    # Return the classifier's compact histogram of an image, and the
+    # normalized dense histogram that OpenCV compares.
+    dense = cv2.calcHist([image], [0, 1, 2], None,
+                         [classifier.binsPerChannel] * 3,
+                         classifier._ranges)
+    return classifier.createHist(image), dense / dense.sum()
+
+@pytest.mark.parametrize('binsPerChannel', [256, 32, 8])
+def testSparseIntersectionMatchesDense(binsPerChannel):
+    classifier = HC.HistogramClassifier(binsPerChannel)
+    hists = [_createHists(classifier, image) for image in _createImages(4)]
+    for sparseA, denseA in hists:
+        for sparseB, denseB in hists:
+            expected = cv2.compareHist(denseA, denseB,
+                                       cv2.HISTCMP_INTERSECT)
+            assert HC.intersectSparseHists(sparseA, sparseB) == \
+                    pytest.approx(expected, abs=1e-5)
+            # Packing the indices does not change the result.
+            assert HC.intersectSparseHists(sparseA.packed(), sparseB) == \
+                    pytest.approx(expected, abs=1e-5)
+
+def testSparseIntersectionOfEmptyHist():
+    empty = HC.CompactHist.fromCounts([], [])
+    hist = HC.CompactHist.fromCounts([3, 7], [2, 5])
+    assert HC.intersectSparseHists(empty, hist) == 0.0
+    assert HC.intersectSparseHists(hist, empty.packed()) == 0.0
+
+def testPackedIndicesRoundTrip():
+    indices = numpy.array([0, 5, 65535, 65536, 70000, 16777215],
+                          numpy.int32)
+    hist = HC.CompactHist.fromCounts(indices, numpy.arange(1, 7))
+    packed = hist.packed()
+    assert packed.indices.dtype == numpy.int32
+    assert numpy.array_equal(packed.indices, indices)
+    assert packed.numOccupiedBins == len(indices)
+    assert packed.packed() is packed
+
+@pytest.mark.parametrize('binsPerChannel', [256, 16])
+def testBinIndexMatchesExhaustiveScoring(binsPerChannel):
+    images = _createImages(12)
+    classifier = _createClassifier(binsPerChannel, images)
+    queries = _createImages(5, seed=1) + images[:2]
+    labels = [classifier.classify(query) for query in queries]
+    classifier.useBinIndex = True
+    assert [classifier.classify(query) for query in queries] == labels
+    binIndex = classifier._getBinIndex()
+    for query in queries:
+        queryHist = _createHists(classifier, query)[0]
+        similarities = binIndex.similarities(queryHist)
+        for label, referenceHists in classifier._references.items():
+            expected = numpy.mean([HC.intersectSparseHists(hist, queryHist)
+                                   for hist in referenceHists])
+            assert similarities[label] == pytest.approx(expected, abs=1e-6)
+
+def testConcurrentFirstClassifyWithBinIndex():
+    images = _createImages(24)
+    queries = _createImages(3, seed=1)
+    labels = [_createClassifier(16, images).classify(query)
+              for query in queries]
+    for trial in range(5):
+        classifier = _createClassifier(16, images)
+        classifier.useBinIndex = True
+        assert _runConcurrently(lambda: [classifier.classify(query)
+                                         for query in queries]) == \
+                [labels] * 8
+        assert classifier._getBinIndex()._numReferences == len(images)
+        assert [classifier.classify(query) for query in queries] == labels
+
+def testBinIndexRejectsPruningAndTwoStage():
+    images = _createImages(3)
+    classifier = _createClassifier(16, images)
+    classifier.useBinIndex = True
+    classifier.useTwoStage = True
+    with pytest.raises(ValueError):
+        classifier.classify(images[0])
+
+@pytest.mark.parametrize('binsPerChannel', [256, 16])
+def testPruningMatchesExhaustiveScoring(binsPerChannel):
+    images = _createImages(24)
+    classifier = _createClassifier(binsPerChannel, images)
+    queries = _createImages(5, seed=1) + images
+    labels = [classifier.classify(query) for query in queries]
+    classifier.usePruning = True
+    assert [classifier.classify(query) for query in queries] == labels
+    assert classifier.pruningStats['labelsPruned'] > 0
+
+def testRebinnedModelMatchesItsImages():
+    images = _createImages(3)
+    classifier = _createClassifier(256, images, len(images))
+    classifier.rebin(16)
+    for i, image in enumerate(images):
+        label, similarities = classifier.classifyWithSimilarities(image)
+        assert label == 'label%d' % i
+        assert similarities[label] == pytest.approx(1.0)
+
+def testConcurrentFirstClassifyWithTwoStage():
+    images = _createImages(24)
+    query = _createImages(1, seed=1)[0]
+    def createClassifier():
+        classifier = _createClassifier(16, images)
+        classifier.useTwoStage = True
+        return classifier
+    label = createClassifier().classify(query)
+    labelMap = createClassifier().classifyRegions(query)[0]
+    for trial in range(5):
+        classifier = createClassifier()
+        assert _runConcurrently(lambda: classifier.classify(query)) == \
+                [label] * 8
+        classifier = createClassifier()
+        for labelMapOfThread in _runConcurrently(
+                lambda: classifier.classifyRegions(query)[0]):
+            assert numpy.array_equal(labelMapOfThread, labelMap)
+
+def testTwoStageTopLabelsMustBePositive():
+    classifier = HC.HistogramClassifier(16)
+    with pytest.raises(ValueError):
+        classifier.twoStageTopLabels = 0
+    classifier.twoStageTopLabels = 1
+    classifier.twoStageTopLabels = None
+
+def testTwoStageMarginWithoutLabels():
+    classifier = HC.HistogramClassifier(16)
+    classifier.useTwoStage = True
+    classifier.twoStageTopLabels = 1
+    classifier.twoStageMargin = 0.1
+    assert classifier.classify(_createImages(1)[0]) == 'Unknown'
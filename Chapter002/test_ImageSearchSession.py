@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from ImageSearchSession import ImageSearchSession
+import RequestsUtils
+import SearchStandIn
+
+
+MALFORMED_URL = 'http://[::1/bad.jpg'
+
+@pytest.fixture
+def server():
+    settings = SearchStandIn.StandInSettings()
+    settings.searchLatency = 0.0
+    settings.imageLatency = 0.0
+    settings.latencyJitter = 0.0
+    settings.totalEstimatedMatches = 20
+    server = SearchStandIn.StandInServer(
+            SearchStandIn.createSyntheticImages(4, 64, 48), settings,
+            port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def session(server, monkeypatch):
+    # The stand-in accepts any key.
+    monkeypatch.setenv('BING_SEARCH_KEY', 'stand-in')
+    session = ImageSearchSession()
+    session.searchUrl = server.searchUrl
+    session.searchesPerSecond = None
+    session.searchResultCache = None
+    session.prefetchRadius = 2
+    return session
+
+def _callWithTimeout(function, *args):
+    # Return the result of the function, failing if it hangs.
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function(*args)))
+    thread.daemon = True
+    thread.start()
+    thread.join(10.0)
+    assert results, 'The call did not return'
+    return results[0]
+
+def _waitUntilCached(session, indices):
+    deadline = time.time() + 10.0
+    while not all(session.isCached(index) for index in indices):
+        assert time.time() < deadline, 'The prefetch did not finish'
+        time.sleep(0.01)
+
+def testSearch(session, server):
+    session.search('tropical beach', 6)
+    assert session.numResultsReceived == 6
+    assert session.numResultsAvailable == 20
+    assert server.counts()['searches'] == 1
+    image, url, label = session.getCvImageUrlAndLabel(0)
+    assert image is not None
+    assert url == session.getUrl(0)
+    assert label is None
+
+def testPrefetch(session):
+    session.search('tropical beach', 6)
+    session.getCvImageUrlAndLabel(2)
+    _waitUntilCached(session, [0, 1, 3, 4])
+    assert not session.isCached(5)
+    image, url, label = session.getCvImageUrlAndLabel(3)
+    assert image is not None
+
+def testPrefetchOfMalformedUrlFinishes(session):
+    session.search('tropical beach', 6)
+    session._results[1].content_url = MALFORMED_URL
+    session.getCvImageUrlAndLabel(0)
+    image, url, label = _callWithTimeout(session.getCvImageUrlAndLabel, 1)
+    assert image is None
+    assert url == MALFORMED_URL
+
+def testPrefetchThatRaisesFinishes(session, monkeypatch):
+    cvImageFromUrl = RequestsUtils.cvImageFromUrl
+    def failOnSecondResult(url, *args, **kwargs):
+        if url == failingUrl:
+            raise RuntimeError('Simulated failure')
+        return cvImageFromUrl(url, *args, **kwargs)
+    monkeypatch.setattr(RequestsUtils, 'cvImageFromUrl', failOnSecondResult)
+    session.search('tropical beach', 6)
+    failingUrl = session.getUrl(1)
+    session.getCvImageUrlAndLabel(0)
+    image, url, label = _callWithTimeout(session.getCvImageUrlAndLabel, 1)
+    assert image is None
+    # The prefetch threads survive the failure.
+    session.getCvImageUrlAndLabel(3)
+    _waitUntilCached(session, [4, 5])
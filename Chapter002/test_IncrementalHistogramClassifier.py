@@ -0,0 +1,54 @@
+import numpy
+
+import HistogramClassifier as HC
+import IncrementalHistogramClassifier as IHC
+
+
+def _createImages(count, seed=0):
+    random = numpy.random.RandomState(seed)
+    return [random.randint(0, 256, (20, 30, 3)).astype(numpy.uint8)
+            for i in range(count)]
+
+def testNoEmptySegments(tmp_path):
+    modelPath = str(tmp_path / 'model.hist')
+    classifier = IHC.IncrementalHistogramClassifier(modelPath, 16)
+    assert not classifier.compact()
+    classifier.close()
+    classifier = IHC.IncrementalHistogramClassifier(modelPath, 16)
+    classifier.addReference(_createImages(1)[0], 'label0')
+    assert classifier.compact()
+    classifier.close()
+    assert HC.listSegments(modelPath) == []
+
+def testTornAppendIsIgnored(tmp_path):
+    modelPath = str(tmp_path / 'model.hist')
+    images = _createImages(4)
+    classifier = IHC.IncrementalHistogramClassifier(modelPath, 16)
+    for i, image in enumerate(images[:3]):
+        classifier.addReference(image, 'label%d' % i)
+    classifier.close()
+    # Append half of a record, as a crash during an append would.
+    segments = HC.listSegments(modelPath)
+    assert len(segments) == 1
+    record = HC.encodeSegmentRecord(
+            16, 'torn', classifier.createHist(images[3]))
+    with open(segments[0][1], 'ab') as file:
+        file.write(record[:len(record) // 2])
+    # The complete records are recovered.
+    classifier = IHC.IncrementalHistogramClassifier(modelPath, 16)
+    assert classifier.numPendingReferences == 3
+    assert sorted(classifier._references) == ['label0', 'label1', 'label2']
+    for i, image in enumerate(images[:3]):
+        assert classifier.classify(image) == 'label%d' % i
+    # Later references go to a new segment, after the torn record.
+    classifier.addReference(images[3], 'label3')
+    classifier.close()
+    assert len(HC.listSegments(modelPath)) == 2
+    classifier = IHC.IncrementalHistogramClassifier(modelPath, 16)
+    assert classifier.numPendingReferences == 4
+    assert classifier.classify(images[3]) == 'label3'
+    assert classifier.compact()
+    classifier.close()
+    assert HC.listSegments(modelPath) == []
+    binsPerChannel, references, generation = HC.readModel(modelPath)
+    assert sum(len(hists) for hists in references.values()) == 4
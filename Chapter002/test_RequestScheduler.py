@@ -0,0 +1,72 @@
+import email.utils
+import time
+
+import pytest
+
+import RequestScheduler
+
+
+URL = 'http://example.com/images/1.jpg'
+SEARCH_URL = 'http://example.com/search?q=beach'
+
+def testParseRetryAfter():
+    assert RequestScheduler.parseRetryAfter(None) is None
+    assert RequestScheduler.parseRetryAfter(' 2.5 ') == 2.5
+    assert RequestScheduler.parseRetryAfter('-1') == 0.0
+    assert RequestScheduler.parseRetryAfter('soon') is None
+    date = email.utils.formatdate(time.time() + 30.0, usegmt=True)
+    assert 25.0 < RequestScheduler.parseRetryAfter(date) <= 30.0
+
+def testCapPerHost():
+    scheduler = RequestScheduler.RequestScheduler(maxRequestsPerHost=2)
+    slots = [scheduler.acquire(URL), scheduler.acquire(URL)]
+    assert scheduler.acquire(URL, timeout=0.05) is None
+    # Other hosts are not limited by this host's requests.
+    with scheduler.acquire('http://example.org/1.jpg', timeout=0.05) \
+            as otherSlot:
+        assert otherSlot is not None
+    slots[0].release()
+    slot = scheduler.acquire(URL, timeout=0.05)
+    assert slot is not None
+    slot.release()
+    slots[1].release()
+    assert scheduler.stats()['hosts'] == 0
+
+def testRateLimitOfEndpoint():
+    scheduler = RequestScheduler.RequestScheduler()
+    scheduler.setRateLimit(SEARCH_URL, 20.0)
+    startTime = time.time()
+    for i in range(4):
+        scheduler.acquire(SEARCH_URL).release()
+    # The first request uses the burst and the rest wait for tokens.
+    assert time.time() - startTime >= 0.13
+    # The rest of the host is not rate-limited.
+    startTime = time.time()
+    for i in range(4):
+        scheduler.acquire(URL).release()
+    assert time.time() - startTime < 0.05
+
+def testBackoffAfterRetryAfter():
+    scheduler = RequestScheduler.RequestScheduler()
+    with scheduler.acquire(URL) as slot:
+        slot.report(429, '0.2')
+    startTime = time.time()
+    assert scheduler.acquire(URL, timeout=0.05) is None
+    scheduler.acquire(URL).release()
+    assert time.time() - startTime >= 0.15
+    stats = scheduler.stats()
+    assert stats['backoffs'] == 1
+    assert stats['waits'] == 1
+
+def testBackoffIsCapped():
+    scheduler = RequestScheduler.RequestScheduler(maxBackoffSeconds=0.1)
+    with scheduler.acquire(URL) as slot:
+        slot.report(503, '3600')
+    startTime = time.time()
+    scheduler.acquire(URL).release()
+    assert time.time() - startTime < 1.0
+
+def testMalformedUrl():
+    scheduler = RequestScheduler.RequestScheduler()
+    with pytest.raises(ValueError):
+        scheduler.acquire('http://[::1/bad.jpg')
@@ -0,0 +1,54 @@
+import pytest
+
+import RequestsUtils
+
+
+MALFORMED_URL = 'http://[::1/bad.jpg'
+
+def testMalformedUrl():
+    import requests
+    with pytest.raises(requests.exceptions.InvalidURL):
+        RequestsUtils.get(MALFORMED_URL)
+    assert RequestsUtils.getContent(MALFORMED_URL) is None
+    assert RequestsUtils.cvImageFromUrl(MALFORMED_URL) is None
+
+class _NotModifiedResponse(object):
+
+    status_code = 304
+    headers = {}
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def diskCache(tmp_path):
+    diskCache = RequestsUtils.DiskCache(str(tmp_path))
+    RequestsUtils.setDiskCache(diskCache)
+    yield diskCache
+    RequestsUtils.setDiskCache(None)
+
+def testCachedBodyLargerThanMaxBytes(diskCache, monkeypatch):
+    url = 'http://localhost/large.jpg'
+    body = b'x' * 100
+    diskCache.write(url, body, etag='"1"')
+    # A fresh entry
+    assert RequestsUtils.getContent(url, maxBytes=50) is None
+    assert RequestsUtils.getContent(url, maxBytes=100) == body
+    # A stale entry that the server reports as not modified
+    diskCache.maxAge = 0.0
+    monkeypatch.setattr(RequestsUtils, 'get',
+                        lambda *args, **kwargs: _NotModifiedResponse())
+    assert RequestsUtils.getContent(url, maxBytes=50) is None
+    assert RequestsUtils.getContent(url, maxBytes=100) == body
+    assert diskCache.stats()['hits'] == 1
+    assert diskCache.stats()['revalidations'] == 1
+
+def testJpegSize():
+    import cv2
+    import numpy
+    image = numpy.zeros((30, 50, 3), numpy.uint8)
+    for extension in ('.jpg', '.png'):
+        data = cv2.imencode(extension, image)[1].tobytes()
+        expected = (50, 30) if extension == '.jpg' else None
+        assert RequestsUtils.getJpegSize(data) == expected
+        assert RequestsUtils.getJpegSize(memoryview(data)) == expected
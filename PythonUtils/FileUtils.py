@@ -0,0 +1,5 @@
+import os
+
+
+# Python 2 lacks os.replace but os.rename overwrites on POSIX.
+replaceFile = getattr(os, 'replace', os.rename)
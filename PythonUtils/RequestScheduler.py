@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+
+import email.utils
+import random
+import threading
+import time
+
+try:
+    # Python 3
+    from urllib.parse import urlsplit
+except ImportError:
+    # Python 2
+    from urlparse import urlsplit
+
+
+# The default maximum number of concurrent requests to each host.
+MAX_REQUESTS_PER_HOST = 8
+
+# The default backoff after the first response of 429 (Too Many
+# Requests) or 503 (Service Unavailable) without a Retry-After header,
+# doubled after each consecutive one, and the maximum backoff, in
+# seconds. Retry-After is also limited to the maximum.
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# The status codes that mean a host wants fewer requests.
+BACKOFF_STATUS_CODES = (429, 503)
+
+
+def hostOf(url):
+    # Return the scheme and host of a URL, which identify the host's
+    # limits.
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc.lower())
+
+def endpointOf(url):
+    # Return a URL without its query or fragment.
+    parts = urlsplit(url)
+    return '%s://%s%s' % (parts.scheme, parts.netloc.lower(), parts.path)
+
+def parseRetryAfter(value):
+    # Return the seconds to wait according to a Retry-After header,
+    # which is either a number of seconds or an HTTP date, or None.
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+class _HostState(object):
+
+    __slots__ = ('numActive', 'blockedUntil', 'numBackoffs', 'rate',
+                 'burst', 'tokens', 'refillTime')
+
+    def __init__(self):
+        self.numActive = 0
+        self.blockedUntil = 0.0
+        # The number of consecutive responses that asked for backoff.
+        self.numBackoffs = 0
+        # The token bucket, if the host has a rate limit.
+        self.rate = None
+        self.burst = 1
+        self.tokens = 0.0
+        self.refillTime = 0.0
+
+    def isIdle(self, now):
+        return self.numActive == 0 and self.blockedUntil <= now and \
+                self.numBackoffs == 0 and self.rate is None
+
+class RequestSlot(object):
+
+    # Permission to make one request to a host. Report the response's
+    # status and Retry-After header, and release the slot when the
+    # response has been read.
+
+    def __init__(self, scheduler, host):
+        self._scheduler = scheduler
+        self._host = host
+        self._released = False
+
+    @property
+    def host(self):
+        return self._host
+
+    def report(self, statusCode, retryAfter=None):
+        self._scheduler._report(self._host, statusCode, retryAfter)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self._host)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+class RequestScheduler(object):
+
+    # Decides when each request to a host may start, for any number of
+    # threads. Each host has a cap on concurrent requests. An endpoint,
+    # such as a search API, may have a rate limit, which is a token
+    # bucket, and its own cap, separate from the rest of its host. When
+    # a host or endpoint responds 429 or 503, every request to it waits
+    # for the Retry-After delay, or else for an exponential backoff, so
+    # that the threads do not repeat the error. After a backoff, a
+    # rate-limited endpoint's bucket starts empty, so requests resume at
+    # the steady rate rather than in a burst.
+
+    def __init__(self, maxRequestsPerHost=MAX_REQUESTS_PER_HOST,
+                 backoffSeconds=BACKOFF_SECONDS,
+                 maxBackoffSeconds=MAX_BACKOFF_SECONDS):
+        self.maxRequestsPerHost = maxRequestsPerHost
+        self.backoffSeconds = backoffSeconds
+        self.maxBackoffSeconds = maxBackoffSeconds
+
+        self._condition = threading.Condition()
+        # The states of hosts and of rate-limited endpoints, by key.
+        self._hosts = {}
+        self._rateLimitedEndpoints = set()
+        self._stats = {
+            'requests': 0,
+            'waits': 0,
+            'waitSeconds': 0.0,
+            'backoffs': 0
+        }
+
+    def setRateLimit(self, url, requestsPerSecond, burst=1):
+        # Limit the rate of requests to the endpoint of a URL, allowing
+        # bursts of up to burst requests, or remove the limit if
+        # requestsPerSecond is None.
+        host = endpointOf(url)
+        with self._condition:
+            state = self._getState(host)
+            if state.rate == requestsPerSecond and state.burst == burst:
+                return
+            if requestsPerSecond is None:
+                self._rateLimitedEndpoints.discard(host)
+            else:
+                self._rateLimitedEndpoints.add(host)
+            state.rate = requestsPerSecond
+            state.burst = burst
+            state.tokens = float(burst)
+            state.refillTime = time.time()
+            self._forgetIfIdle(host, state, time.time())
+            self._condition.notify_all()
+
+    def acquire(self, url, timeout=None):
+        # Wait until a request to the URL's host may start, and return
+        # a RequestSlot, or None if the timeout elapses first.
+        startTime = time.time()
+        waited = False
+        with self._condition:
+            host = self._keyOf(url)
+            state = self._getState(host)
+            while True:
+                now = time.time()
+                delay = state.blockedUntil - now
+                if delay <= 0.0:
+                    if state.numActive >= self.maxRequestsPerHost:
+                        # Wait for a release.
+                        delay = None
+                    elif state.rate is None:
+                        break
+                    else:
+                        state.tokens = min(
+                                float(state.burst),
+                                state.tokens + (now - state.refillTime) * \
+                                        state.rate)
+                        state.refillTime = now
+                        if state.tokens >= 1.0:
+                            state.tokens -= 1.0
+                            break
+                        delay = (1.0 - state.tokens) / state.rate
+                if timeout is not None:
+                    remaining = startTime + timeout - now
+                    if remaining <= 0.0:
+                        self._forgetIfIdle(host, state, now)
+                        return None
+                    delay = remaining if delay is None else \
+                            min(delay, remaining)
+                waited = True
+                self._condition.wait(delay)
+                # Another thread may have forgotten the state.
+                state = self._getState(host)
+            state.numActive += 1
+            self._stats['requests'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['waitSeconds'] += time.time() - startTime
+        return RequestSlot(self, host)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            now = time.time()
+            stats['hosts'] = len(self._hosts)
+            stats['hostsBackingOff'] = sum(
+                    1 for state in self._hosts.values()
+                    if state.blockedUntil > now)
+        return stats
+
+    def _keyOf(self, url):
+        if self._rateLimitedEndpoints:
+            endpoint = endpointOf(url)
+            if endpoint in self._rateLimitedEndpoints:
+                return endpoint
+        return hostOf(url)
+
+    def _getState(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState()
+            self._hosts[host] = state
+        return state
+
+    def _forgetIfIdle(self, host, state, now):
+        # Keep the state of only the hosts that need it, so that
+        # crawling many hosts does not accumulate states.
+        if state.isIdle(now) and self._hosts.get(host) is state:
+            del self._hosts[host]
+
+    def _report(self, host, statusCode, retryAfter):
+        with self._condition:
+            state = self._getState(host)
+            now = time.time()
+            if statusCode in BACKOFF_STATUS_CODES:
+                state.numBackoffs += 1
+                seconds = parseRetryAfter(retryAfter)
+                if seconds is None:
+                    # Jitter the backoff, so that several clients do
+                    # not retry together.
+                    seconds = self.backoffSeconds * \
+                            2 ** (state.numBackoffs - 1) * \
+                            random.uniform(0.5, 1.0)
+                seconds = min(seconds, self.maxBackoffSeconds)
+                state.blockedUntil = max(state.blockedUntil, now + seconds)
+                if state.rate is not None:
+                    state.tokens = 0.0
+                    state.refillTime = state.blockedUntil
+                self._stats['backoffs'] += 1
+            elif statusCode < 500:
+                state.numBackoffs = 0
+                self._forgetIfIdle(host, state, now)
+
+    def _release(self, host):
+        with self._condition:
+            state = self._getState(host)
+            state.numActive -= 1
+            self._forgetIfIdle(host, state, time.time())
+            self._condition.notify_all()
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
 
+import hashlib
+import json
 import numpy # Hint to PyInstaller
 import cv2
-import requests
+import os
+import struct
 import sys
+import threading
+import time
+
+import FileUtils
+import RequestScheduler
 
 
 # Spoof a browser's User-Agent string.
@@ -15,6 +23,535 @@ HEADERS = {
                   'Gecko/20100101 Firefox/25.0'
 }
 
+# The default timeouts, in seconds, to connect and to wait for each
+# read of the response.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+# The default number of retries of transient errors, and the factor of
+# the exponential backoff between them, in seconds.
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# The status codes that are worth retrying immediately. Responses of 429
+# and 503 are retried after the scheduler's backoff instead, so that
+# every thread backs off from the host.
+RETRY_STATUS_CODES = (500, 502, 504)
+
+# The default number of hosts whose pools of connections are kept, and
+# the maximum number of idle connections that are kept per host.
+NUM_POOLS = 32
+MAX_CONNECTIONS_PER_HOST = 8
+
+# The default maximum size of a response body, in bytes.
+MAX_CONTENT_BYTES = 32*1024*1024
+
+# The size of each chunk of a streamed response body, in bytes.
+CHUNK_BYTES = 64*1024
+
+# The decoding flags for JPEGs that are reduced by each factor.
+_REDUCED_IMREAD_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+# JPEG start-of-frame markers, which precede the image's dimensions.
+_JPEG_SOF_MARKERS = frozenset(
+        [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+         0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+
+class _Transport(object):
+
+    # Settings and a pool of keep-alive connections per host, shared by
+    # every thread. Each thread has its own Session, because Sessions
+    # are not thread-safe, but all of the Sessions use the same pools.
+
+    def __init__(self, connectTimeout, readTimeout, maxRetries,
+                 backoffFactor, numPools, maxConnectionsPerHost):
+        # requests is slow to import, so defer it until it is needed.
+        import requests.adapters
+        from urllib3.util.retry import Retry
+
+        self.timeout = (connectTimeout, readTimeout)
+        retryArgs = {
+            'total': maxRetries,
+            'backoff_factor': backoffFactor,
+            'status_forcelist': RETRY_STATUS_CODES,
+            # Otherwise, urllib3 retries 429 and 503 itself.
+            'respect_retry_after_header': False,
+            'raise_on_status': False
+        }
+        try:
+            retry = Retry(allowed_methods=frozenset(['GET', 'HEAD']),
+                          **retryArgs)
+        except TypeError:
+            # urllib3 before 1.26
+            retry = Retry(method_whitelist=frozenset(['GET', 'HEAD']),
+                          **retryArgs)
+        self.adapter = requests.adapters.HTTPAdapter(
+                pool_connections=numPools,
+                pool_maxsize=maxConnectionsPerHost,
+                max_retries=retry)
+
+        # Count the requests and connections of pools that are evicted,
+        # in addition to those of pools that are still open.
+        self._statsLock = threading.Lock()
+        self._numDisposedRequests = 0
+        self._numDisposedConnections = 0
+        pools = self.adapter.poolmanager.pools
+        disposeFunc = pools.dispose_func
+        def dispose(pool):
+            with self._statsLock:
+                self._numDisposedRequests += pool.num_requests
+                self._numDisposedConnections += pool.num_connections
+            if disposeFunc is not None:
+                # Older versions of urllib3 close evicted pools here.
+                disposeFunc(pool)
+        pools.dispose_func = dispose
+
+        self._local = threading.local()
+
+    def getSession(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+
+    def stats(self):
+        with self._statsLock:
+            numRequests = self._numDisposedRequests
+            numConnections = self._numDisposedConnections
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                # The pool was evicted, so it has been counted above.
+                continue
+            numRequests += pool.num_requests
+            numConnections += pool.num_connections
+        return {
+            'requests': numRequests,
+            'newConnections': numConnections,
+            'reusedConnections': numRequests - numConnections
+        }
+
+    def close(self):
+        self.adapter.close()
+
+_transportLock = threading.Lock()
+_transport = None
+_transportSettings = {
+    'connectTimeout': CONNECT_TIMEOUT,
+    'readTimeout': READ_TIMEOUT,
+    'maxRetries': MAX_RETRIES,
+    'backoffFactor': BACKOFF_FACTOR,
+    'numPools': NUM_POOLS,
+    'maxConnectionsPerHost': MAX_CONNECTIONS_PER_HOST
+}
+
+def configureTransport(**settings):
+    # Change any of the settings in _transportSettings. The pools are
+    # closed, and new ones are created with the new settings.
+    with _transportLock:
+        for name in settings:
+            if name not in _transportSettings:
+                raise ValueError('Unknown transport setting: %s' % name)
+        _transportSettings.update(settings)
+        _closeTransport()
+
+def _getTransport():
+    global _transport
+    with _transportLock:
+        if _transport is None:
+            _transport = _Transport(**_transportSettings)
+        return _transport
+
+def _closeTransport():
+    global _transport
+    if _transport is not None:
+        _transport.close()
+        _transport = None
+
+def closeTransport():
+    with _transportLock:
+        _closeTransport()
+
+def _forgetTransportInChild():
+    # A forked process must not share the parent's connections, and
+    # the locks may have been held by other threads at the fork.
+    global _transport, _transportLock, _scheduler
+    _transport = None
+    _transportLock = threading.Lock()
+    if _scheduler is not None:
+        _scheduler = RequestScheduler.RequestScheduler(
+                _scheduler.maxRequestsPerHost, _scheduler.backoffSeconds,
+                _scheduler.maxBackoffSeconds)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forgetTransportInChild)
+
+def getSession():
+    # Return this thread's Session, which shares a pool of connections
+    # per host with the other threads' Sessions.
+    return _getTransport().getSession()
+
+def connectionStats():
+    # Return the counts of requests, new connections and reused
+    # connections. Retries count as requests.
+    return _getTransport().stats()
+
+_scheduler = RequestScheduler.RequestScheduler()
+
+def setScheduler(scheduler):
+    # Use a RequestScheduler, or None, to decide when requests start.
+    global _scheduler
+    _scheduler = scheduler
+
+def getScheduler():
+    return _scheduler
+
+def _releaseOnClose(response, slot):
+    close = response.close
+    def closeAndRelease():
+        try:
+            close()
+        finally:
+            slot.release()
+    response.close = closeAndRelease
+
+def get(url, **kwargs):
+    # Make a GET request with the shared pools, timeouts and retries.
+    # The request waits for the scheduler, and responses of 429 and 503
+    # make every request to the host back off, and are retried. A
+    # streamed response holds its host's slot until it is closed.
+    # Raise requests.exceptions.RequestException on failure.
+    transport = _getTransport()
+    kwargs.setdefault('timeout', transport.timeout)
+    scheduler = _scheduler
+    if scheduler is None:
+        return transport.getSession().get(url, **kwargs)
+    maxRetries = _transportSettings['maxRetries']
+    for attempt in range(maxRetries + 1):
+        try:
+            slot = scheduler.acquire(url)
+        except ValueError as e:
+            # The scheduler parses the URL before requests does, so
+            # report a malformed URL as requests would.
+            import requests
+            raise requests.exceptions.InvalidURL(str(e))
+        try:
+            response = transport.getSession().get(url, **kwargs)
+        except:
+            slot.release()
+            raise
+        slot.report(response.status_code,
+                    response.headers.get('Retry-After'))
+        if attempt == maxRetries or response.status_code not in \
+                RequestScheduler.BACKOFF_STATUS_CODES:
+            break
+        response.close()
+        slot.release()
+    if kwargs.get('stream'):
+        _releaseOnClose(response, slot)
+    else:
+        slot.release()
+    return response
+
+class DiskCache(object):
+
+    # A cache of response bodies on disk, keyed by the SHA-1 of the URL.
+    # Each entry is one file, with a line of JSON metadata followed by
+    # the body. Entries are written to a temporary file and renamed, so
+    # several processes can share a cache directory and never see a
+    # partial entry. An entry's modification time is its last use, and
+    # the least recently used entries are evicted to stay within the
+    # byte budget.
+
+    def __init__(self, directory, maxBytes=256*1024*1024, maxAge=3600.0):
+        # Entries are served without revalidation for maxAge seconds
+        # after they are stored or revalidated.
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'revalidations': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'bytesFromCache': 0,
+            'bytesDownloaded': 0
+        }
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it.
+                if not os.path.isdir(directory):
+                    raise
+        self._numBytes = self._scan()[1]
+        self._numBytesSinceScan = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bytesStored'] = self._numBytes
+        return stats
+
+    def _path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, key[:2], key + '.entry')
+
+    def read(self, url):
+        # Return the metadata and body of the URL's entry, or None.
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as file:
+                metadata = json.loads(file.readline().decode('utf-8'))
+                body = file.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if metadata.get('url') != url or len(body) != metadata.get('size'):
+            return None
+        return metadata, body
+
+    def isFresh(self, metadata):
+        return time.time() - metadata.get('validated', 0) < self.maxAge
+
+    def recordHit(self, url, body, revalidated=False):
+        with self._lock:
+            self._stats['revalidations' if revalidated else 'hits'] += 1
+            self._stats['bytesFromCache'] += len(body)
+        try:
+            # Mark the entry as recently used.
+            os.utime(self._path(url), None)
+        except OSError:
+            pass
+
+    def recordMiss(self):
+        with self._lock:
+            self._stats['misses'] += 1
+
+    def write(self, url, body, etag=None, lastModified=None,
+              downloaded=True):
+        metadata = {
+            'url': url,
+            'size': len(body),
+            'etag': etag,
+            'lastModified': lastModified,
+            'validated': time.time()
+        }
+        path = self._path(url)
+        tempPath = '%s.tmp%d.%d' % (path, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            with open(tempPath, 'wb') as file:
+                file.write(json.dumps(metadata).encode('utf-8'))
+                file.write(b'\n')
+                file.write(body)
+            FileUtils.replaceFile(tempPath, path)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to cache %s:\n' % url)
+            sys.stderr.write('%s\n' % str(e))
+            return
+        with self._lock:
+            self._stats['stores'] += 1
+            if downloaded:
+                self._stats['bytesDownloaded'] += len(body)
+            self._numBytes += len(body)
+            self._numBytesSinceScan += len(body)
+            # Other processes' entries are only found by scanning, so
+            # scan after storing a fraction of the budget.
+            needsScan = self._numBytes > self.maxBytes or \
+                    self._numBytesSinceScan > self.maxBytes // 8
+        if needsScan:
+            self.evict()
+
+    def evict(self, targetFraction=0.9):
+        # If the cache is over its budget, delete the least recently used
+        # entries until it is within a fraction of its budget. Rescan
+        # first, because other processes may have added or removed
+        # entries.
+        entries, numBytes = self._scan()
+        numEvictions = 0
+        targetBytes = self.maxBytes
+        if numBytes > self.maxBytes:
+            targetBytes = self.maxBytes * targetFraction
+        for lastUsed, size, path in sorted(entries):
+            if numBytes <= targetBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process removed it, or on Windows, is reading.
+                continue
+            numBytes -= size
+            numEvictions += 1
+        with self._lock:
+            self._numBytes = numBytes
+            self._numBytesSinceScan = 0
+            self._stats['evictions'] += numEvictions
+
+    def _scan(self):
+        # Return the (last use, size, path) of each entry and the total
+        # size. Remove temporary files that were abandoned by crashes.
+        entries = []
+        numBytes = 0
+        now = time.time()
+        for dirPath, dirNames, fileNames in os.walk(self._directory):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                try:
+                    stat = os.stat(path)
+                    if fileName.endswith('.entry'):
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                        numBytes += stat.st_size
+                    elif '.tmp' in fileName and \
+                            now - stat.st_mtime > 3600.0:
+                        os.remove(path)
+                except OSError:
+                    continue
+        return entries, numBytes
+
+_diskCache = None
+
+def setDiskCache(diskCache):
+    # Use a DiskCache, or None, for the bodies of GET requests.
+    global _diskCache
+    _diskCache = diskCache
+
+def getDiskCache():
+    return _diskCache
+
+_bufferLocal = threading.local()
+
+def _getBuffer(minSize):
+    # Return this thread's reusable buffer, enlarged if necessary.
+    buffer = getattr(_bufferLocal, 'buffer', None)
+    if buffer is None or len(buffer) < minSize:
+        newBuffer = bytearray(max(minSize, 2 * len(buffer or b'')))
+        if buffer is not None:
+            newBuffer[:len(buffer)] = buffer
+        buffer = newBuffer
+        _bufferLocal.buffer = buffer
+    return buffer
+
+def _readBody(response, url, maxBytes):
+    # Stream the body into this thread's buffer and return a view of it,
+    # or None if it is larger than maxBytes.
+    try:
+        expectedSize = int(response.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        expectedSize = None
+    if expectedSize is not None and expectedSize > maxBytes:
+        sys.stderr.write('Refused %s because its size (%d bytes) exceeds '
+                         '%d bytes\n' % (url, expectedSize, maxBytes))
+        return None
+    buffer = _getBuffer(expectedSize or CHUNK_BYTES)
+    size = 0
+    for chunk in response.iter_content(CHUNK_BYTES):
+        end = size + len(chunk)
+        if end > maxBytes:
+            sys.stderr.write('Refused %s because its size exceeds %d '
+                             'bytes\n' % (url, maxBytes))
+            return None
+        if end > len(buffer):
+            buffer = _getBuffer(end)
+        buffer[size:end] = chunk
+        size = end
+    return memoryview(buffer)[:size]
+
+def _isCachedBodyTooLarge(body, url, maxBytes):
+    # The cached copy may have been stored under a larger maxBytes.
+    if len(body) > maxBytes:
+        sys.stderr.write('Refused %s because its cached size (%d bytes) '
+                         'exceeds %d bytes\n' % (url, len(body), maxBytes))
+        return True
+    return False
+
+def getContent(url, maxBytes=MAX_CONTENT_BYTES, useBuffer=False):
+    # Return the body of a successful GET request, or None if the
+    # request fails or the body is larger than maxBytes. If there is a
+    # disk cache, fresh entries are served from it, and stale entries
+    # are revalidated with a conditional request.
+    # The body is streamed into a buffer that is reused by the thread.
+    # If useBuffer is True, the body is returned as a view of that
+    # buffer, which is only valid until the thread's next request.
+    import requests
+    diskCache = _diskCache
+    entry = None
+    headers = {}
+    if diskCache is not None:
+        entry = diskCache.read(url)
+        if entry is not None:
+            metadata, body = entry
+            if diskCache.isFresh(metadata):
+                if _isCachedBodyTooLarge(body, url, maxBytes):
+                    return None
+                diskCache.recordHit(url, body)
+                return body
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('lastModified'):
+                headers['If-Modified-Since'] = metadata['lastModified']
+    response = None
+    try:
+        response = get(url, headers=headers, stream=True)
+        if response.status_code == 304 and entry is not None:
+            metadata, body = entry
+            if _isCachedBodyTooLarge(body, url, maxBytes):
+                return None
+            diskCache.recordHit(url, body, revalidated=True)
+            # Restart the entry's freshness.
+            diskCache.write(url, body, metadata.get('etag'),
+                            metadata.get('lastModified'), downloaded=False)
+            return body
+        if not validateResponse(response):
+            return None
+        body = _readBody(response, url, maxBytes)
+    except requests.exceptions.RequestException as e:
+        sys.stderr.write('Failed to request %s:\n' % url)
+        sys.stderr.write('%s\n' % str(e))
+        if entry is not None and \
+                not _isCachedBodyTooLarge(entry[1], url, maxBytes):
+            # Serve the stale entry instead of nothing.
+            sys.stderr.write('Using a stale cached copy\n')
+            return entry[1]
+        return None
+    finally:
+        if response is not None:
+            # Return the connection to the pool.
+            response.close()
+    if body is None:
+        return None
+    if diskCache is not None:
+        diskCache.recordMiss()
+        if 'no-store' not in response.headers.get('Cache-Control', ''):
+            diskCache.write(url, body, response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+    if not useBuffer:
+        body = body.tobytes()
+    return body
+
 def validateResponse(response):
     statusCode = response.status_code
     if statusCode == 200:
@@ -25,12 +562,58 @@ def validateResponse(response):
             (statusCode, url))
     return False
 
-def cvImageFromUrl(url):
-    response = requests.get(url, headers=HEADERS)
-    if not validateResponse(response):
+def getJpegSize(data):
+    # Return the (width, height) in a JPEG's start-of-frame segment, or
+    # None if the data is not a JPEG or the segment is not found.
+    # The fields are unpacked with struct because indexing a memoryview
+    # returns a str in Python 2.
+    data = memoryview(data)
+    if data[:2].tobytes() != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 9 <= len(data):
+        prefix, marker = struct.unpack_from('BB', data, position)
+        if prefix != 0xFF:
+            return None
+        if marker == 0xFF:
+            # Padding
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # A marker without a segment
+            position += 2
+            continue
+        length, = struct.unpack_from('>H', data, position + 2)
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, position + 5)
+            return width, height
+        position += 2 + length
+    return None
+
+def chooseImreadFlags(data, targetSize=None):
+    # Return the flags to decode an image in color, reduced by the
+    # largest factor that keeps its larger dimension at least
+    # targetSize. Only JPEGs are reduced, because libjpeg can reduce
+    # them while decoding, at a fraction of the cost.
+    if targetSize is None:
+        return cv2.IMREAD_COLOR
+    size = getJpegSize(data)
+    if size is None:
+        return cv2.IMREAD_COLOR
+    for factor, flags in _REDUCED_IMREAD_FLAGS:
+        if max(size) // factor >= targetSize:
+            return flags
+    return cv2.IMREAD_COLOR
+
+def cvImageFromUrl(url, targetSize=None, maxBytes=MAX_CONTENT_BYTES):
+    # Download and decode an image, or return None. If targetSize is
+    # set, a JPEG is decoded at a reduced resolution whose larger
+    # dimension is still at least targetSize.
+    content = getContent(url, maxBytes, useBuffer=True)
+    if content is None:
         return None
-    imageData = numpy.fromstring(response.content, numpy.uint8)
-    image = cv2.imdecode(imageData, cv2.IMREAD_COLOR)
+    imageData = numpy.frombuffer(content, numpy.uint8)
+    image = cv2.imdecode(imageData, chooseImreadFlags(content, targetSize))
     if image is None:
         sys.stderr.write(
                 'Failed to decode image from content of %s\n' % url)
@@ -38,7 +621,25 @@ def cvImageFromUrl(url):
 
 
 def main():
-    image = cvImageFromUrl('http://nummist.com/images/ceiling.gaze.jpg')
+    # Optionally, request a given URL, such as one on a local server,
+    # several times and show the reuse of connections, optionally with
+    # a disk cache in a given directory.
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+        numRequests = 5
+    else:
+        url = 'http://nummist.com/images/ceiling.gaze.jpg'
+        numRequests = 1
+    if len(sys.argv) > 2:
+        # Use a disk cache in the given directory.
+        setDiskCache(DiskCache(sys.argv[2]))
+    for i in range(numRequests):
+        image = cvImageFromUrl(url)
+    print('Connections: %r' % connectionStats())
+    if _scheduler is not None:
+        print('Scheduler: %r' % _scheduler.stats())
+    if _diskCache is not None:
+        print('Disk cache: %r' % _diskCache.stats())
     if image is not None:
         cv2.imwrite('image.png', image)
 